@@ -0,0 +1,46 @@
+# Scaling of tic_tac_toe.train_parallel() with the number of worker processes.
+#
+#   python -m benchmarks.parallel_training [epochs]
+#
+# For each mode and worker count, prints the training throughput and the
+# compete() win rates of the saved policies. Policy files are written to a
+# temporary directory.
+
+import os
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+
+import tic_tac_toe
+
+WORKERS = [1, 2, 4, 8]
+MODES = ["async", "average"]
+COMPETE_TURNS = 1000
+
+
+def run(epochs):
+    print("mode    | workers | games/s  | p1 win | p2 win | draw")
+    print("--------|---------|----------|--------|--------|------")
+    for mode in MODES:
+        for workers in WORKERS:
+            with redirect_stdout(StringIO()):
+                start = time.perf_counter()
+                tic_tac_toe.train_parallel(epochs, workers=workers, mode=mode)
+                elapsed = time.perf_counter() - start
+                player1_win, player2_win = tic_tac_toe.compete(COMPETE_TURNS)
+            print(
+                f"{mode:7} | {workers:7d} | {epochs / elapsed:8.0f} |"
+                f" {player1_win:6.2f} | {player2_win:6.2f} |"
+                f" {1 - player1_win - player2_win:5.2f}"
+            )
+
+
+if __name__ == "__main__":
+    epochs = int(sys.argv[1]) if len(sys.argv) > 1 else int(1e5)
+    # make sure the state table cache exists before the workers start
+    tic_tac_toe.get_state_table()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        run(epochs)
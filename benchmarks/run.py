@@ -0,0 +1,307 @@
+# Reproducible benchmarks of the hot paths of tic_tac_toe.py and can_collector.py.
+#
+#   python -m benchmarks.run                      run and compare with benchmarks/baseline.json
+#   python -m benchmarks.run --save-baseline      run and store the results as the new baseline
+#   python -m benchmarks.run --only tic_tac_toe   run the benchmarks whose name contains a string
+#
+# Every benchmark is seeded, warmed up and repeated; the median of the runs is
+# reported, and its peak memory is measured in one extra run under tracemalloc
+# (in the child interpreter for the import benchmarks).
+# Results are written as JSON, and a median or a peak memory is flagged as a
+# regression when it is worse than the baseline by more than the tolerance. The exit status is 1
+# if anything regressed.
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import can_collector
+import rng
+import tic_tac_toe
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+SEED = 0
+
+BENCHMARKS = []
+
+
+# register a benchmark, @run performs one measurement and returns its value
+# @peak: returns the peak memory in bytes when it is not @run's own, e.g. of a child process
+def benchmark(name, unit, higher_is_better=False, peak=None):
+    def register(run):
+        BENCHMARKS.append(
+            {
+                "name": name,
+                "unit": unit,
+                "higher_is_better": higher_is_better,
+                "run": run,
+                "peak": peak,
+            }
+        )
+        return run
+
+    return register
+
+
+# run @statement in a fresh interpreter after numpy is imported, print @measure
+def run_import(module, statement, measure):
+    code = "import time, tracemalloc, numpy; %s; import %s; print(%s)" % (
+        statement,
+        module,
+        measure,
+    )
+    return subprocess.check_output([sys.executable, "-c", code], cwd=ROOT)
+
+
+# seconds to import @module in a fresh interpreter, numpy excluded
+def import_time(module):
+    output = run_import(
+        module, "start = time.perf_counter()", "time.perf_counter() - start"
+    )
+    return float(output)
+
+
+# peak bytes traced while importing @module in a fresh interpreter, numpy excluded
+def import_peak(module):
+    output = run_import(
+        module, "tracemalloc.start()", "tracemalloc.get_traced_memory()[1]"
+    )
+    return int(output)
+
+
+@benchmark("tic_tac_toe.import", "s", peak=lambda: import_peak("tic_tac_toe"))
+def tic_tac_toe_import():
+    return import_time("tic_tac_toe")
+
+
+@benchmark("can_collector.import", "s", peak=lambda: import_peak("can_collector"))
+def can_collector_import():
+    return import_time("can_collector")
+
+
+@benchmark("tic_tac_toe.get_all_states", "s")
+def get_all_states():
+    start = time.perf_counter()
+    tic_tac_toe.get_all_states()
+    return time.perf_counter() - start
+
+
+@benchmark("tic_tac_toe.state_table_build", "s")
+def state_table_build():
+    start = time.perf_counter()
+    tic_tac_toe.StateTable.build()
+    return time.perf_counter() - start
+
+
+def trained_judger(epsilon=0.01, games=500):
+    player1 = tic_tac_toe.Player(epsilon=epsilon)
+    player2 = tic_tac_toe.Player(epsilon=epsilon)
+    judger = tic_tac_toe.Judger(player1, player2)
+    for _ in range(games):
+        judger.play()
+        player1.backup()
+        player2.backup()
+        judger.reset()
+    return judger
+
+
+@benchmark("tic_tac_toe.judger_play", "games/s", higher_is_better=True)
+def judger_play(games=2000):
+    judger = trained_judger()
+    start = time.perf_counter()
+    for _ in range(games):
+        judger.play()
+        judger.reset()
+    return games / (time.perf_counter() - start)
+
+
+@benchmark("tic_tac_toe.player_act", "us")
+def player_act(games=200):
+    judger = trained_judger()
+    player = judger.p1
+    elapsed = 0.0
+    moves = 0
+    for _ in range(games):
+        judger.play()
+        states = player.states[:-1]
+        for state in states:
+            player.states = [state]
+            player.greedy = [True]
+            start = time.perf_counter()
+            player.act()
+            elapsed += time.perf_counter() - start
+        moves += len(states)
+        judger.reset()
+    return elapsed / moves * 1e6
+
+
+@benchmark("tic_tac_toe.player_backup", "us")
+def player_backup(games=2000):
+    judger = trained_judger()
+    elapsed = 0.0
+    for _ in range(games):
+        judger.play()
+        start = time.perf_counter()
+        judger.p1.backup()
+        elapsed += time.perf_counter() - start
+        judger.reset()
+    return elapsed / games * 1e6
+
+
+@benchmark("can_collector.play_episode", "episodes/s", higher_is_better=True)
+def play_episode(episodes=100):
+    agent = can_collector.RobotAgent()
+    judger = can_collector.CanCollectionJudger(agent)
+    start = time.perf_counter()
+    for _ in range(episodes):
+        _, rewards = judger.play_episode()
+        agent.backup(rewards)
+    return episodes / (time.perf_counter() - start)
+
+
+@benchmark("can_collector.batch_steps", "steps/s", higher_is_better=True)
+def batch_steps(episodes=5, robots=4096):
+    agent = can_collector.RobotAgent()
+    judger = can_collector.BatchCanCollectionJudger(agent, robots)
+    start = time.perf_counter()
+    for _ in range(episodes):
+        judger.play_episode()
+        judger.backup()
+    return episodes * robots * judger.max_steps / (time.perf_counter() - start)
+
+
+# latency of RobotAgent.act after @history episodes of learned model
+def robot_act(history, calls=500):
+    agent = can_collector.RobotAgent(epsilon=0)
+    judger = can_collector.CanCollectionJudger(agent)
+    for _ in range(history):
+        _, rewards = judger.play_episode()
+        agent.backup(rewards)
+    agent.reset()
+    agent.set_state(can_collector.RobotState(can_collector.LOW_BATTERY))
+    start = time.perf_counter()
+    for _ in range(calls):
+        agent.act()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+for history in (0, 100, 500):
+    benchmark("can_collector.robot_act.history_%d" % history, "us")(
+        lambda history=history: robot_act(history)
+    )
+
+
+def run_benchmark(entry, repeat, warmup):
+    for _ in range(warmup):
+        entry["run"]()
+    runs = []
+    for i in range(repeat):
+        rng.seed(SEED + i)
+        runs.append(entry["run"]())
+    rng.seed(SEED)
+    if entry["peak"] is not None:
+        peak = entry["peak"]()
+    else:
+        tracemalloc.start()
+        entry["run"]()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {
+        "unit": entry["unit"],
+        "higher_is_better": entry["higher_is_better"],
+        "median": statistics.median(runs),
+        "runs": runs,
+        "peak_memory_kb": peak / 1024,
+    }
+
+
+# names of the metrics worse than the baseline by more than @tolerance
+def compare(results, baseline, tolerance):
+    regressions = []
+    print("%-42s %14s %14s %8s" % ("benchmark", "baseline", "current", "change"))
+    for name, result in results.items():
+        if name not in baseline:
+            print("%-42s %14s %14.4g %8s" % (name, "-", result["median"], "new"))
+            continue
+        metrics = [("", "median", result["higher_is_better"])]
+        if "peak_memory_kb" in baseline[name]:
+            metrics.append((" [peak KB]", "peak_memory_kb", False))
+        for suffix, key, higher_is_better in metrics:
+            old = baseline[name][key]
+            new = result[key]
+            change = (new - old) / old if old else 0.0
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > tolerance:
+                flag = "  REGRESSION"
+                regressions.append(name + suffix)
+            print(
+                "%-42s %14.4g %14.4g %+7.0f%%%s"
+                % (name + suffix, old, new, change * 100, flag)
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--only", default="", help="run benchmarks containing this")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    results = {}
+    for entry in BENCHMARKS:
+        if args.only in entry["name"]:
+            results[entry["name"]] = run_benchmark(entry, args.repeat, args.warmup)
+            print(
+                "%-42s %12.4g %-10s peak %8.0f KB"
+                % (
+                    entry["name"],
+                    results[entry["name"]]["median"],
+                    entry["unit"],
+                    results[entry["name"]]["peak_memory_kb"],
+                )
+            )
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "seed": SEED,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        return 0
+    if not os.path.exists(args.baseline):
+        print("No baseline at %s" % args.baseline)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    print()
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("\n%d regression(s): %s" % (len(regressions), ", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
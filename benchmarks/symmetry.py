@@ -0,0 +1,73 @@
+# Training games needed to reach a compete() draw rate with and without
+# the dihedral symmetry mode of tic_tac_toe.Player.
+#
+#   python -m benchmarks.symmetry [target draw rate]
+#
+# Both players train with Judger as in train(). Every CHECK_EVERY games their
+# greedy policies play COMPETE_TURNS games against each other as in compete().
+# A run stops once the draw rate reaches the target for PATIENCE checks in a row.
+
+import sys
+import time
+
+import numpy as np
+
+import rng
+import tic_tac_toe
+
+SEEDS = range(10)
+CHECK_EVERY = 50
+COMPETE_TURNS = 100
+PATIENCE = 3
+MAX_EPOCHS = int(1e5)
+
+
+# draw rate of the greedy policies of two trained players
+def draw_rate(player1, player2, symmetry):
+    greedy1 = tic_tac_toe.Player(epsilon=0, dense=True, symmetry=symmetry)
+    greedy2 = tic_tac_toe.Player(epsilon=0, dense=True, symmetry=symmetry)
+    judger = tic_tac_toe.Judger(greedy1, greedy2)
+    greedy1.estimations = player1.estimations
+    greedy2.estimations = player2.estimations
+    draws = 0
+    for _ in range(COMPETE_TURNS):
+        draws += judger.play() == 0
+        judger.reset()
+    return draws / COMPETE_TURNS
+
+
+# number of training games until the draw rate is reached, and the time it took
+def games_to_target(target, symmetry, seed):
+    rng.seed(seed)
+    player1 = tic_tac_toe.Player(epsilon=0.01, dense=True, symmetry=symmetry)
+    player2 = tic_tac_toe.Player(epsilon=0.01, dense=True, symmetry=symmetry)
+    judger = tic_tac_toe.Judger(player1, player2)
+    start = time.perf_counter()
+    streak = 0
+    for i in range(1, MAX_EPOCHS + 1):
+        judger.play()
+        player1.backup()
+        player2.backup()
+        judger.reset()
+        if i % CHECK_EVERY == 0:
+            streak = (
+                streak + 1 if draw_rate(player1, player2, symmetry) >= target else 0
+            )
+            if streak == PATIENCE:
+                return i - CHECK_EVERY * (PATIENCE - 1), time.perf_counter() - start
+    return MAX_EPOCHS, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    target = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    print(f"target draw rate {target:.2f}, {len(SEEDS)} seeds")
+    print("symmetry | table size | median games | median seconds")
+    print("---------|------------|--------------|---------------")
+    for symmetry in (False, True):
+        results = np.array([games_to_target(target, symmetry, seed) for seed in SEEDS])
+        player = tic_tac_toe.Player(dense=True, symmetry=symmetry)
+        player.set_symbol(1)
+        print(
+            f"{str(symmetry):8} | {len(player.estimations):10d} |"
+            f" {np.median(results[:, 0]):12.0f} | {np.median(results[:, 1]):14.2f}"
+        )
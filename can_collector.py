@@ -9,18 +9,46 @@
 #######################################################################
 
 import pickle
+import threading
+from array import array
+from time import perf_counter
 from typing import Literal
 
 import numpy as np
 
+from checkpoint import Checkpointer, load_checkpoint
+from experience import CHUNK_SIZE, ExperienceLog, chunks
+from mdp import SparseMDP
+from profiling import PROFILER
+from rng import RNG
+from training import Schedule, TrainingController
+
 SEARCH = 0
 WAIT = 1
 RECHARGE = 2
 
+# moves of make_robot_mdp() robots on a grid, as (dx, dy)
+MOVE_UP = 3
+MOVE_DOWN = 4
+MOVE_LEFT = 5
+MOVE_RIGHT = 6
+MOVES = {MOVE_UP: (0, -1), MOVE_DOWN: (0, 1), MOVE_LEFT: (-1, 0), MOVE_RIGHT: (1, 0)}
+
 HIGH_BATTERY = 0
 LOW_BATTERY = 1
 DEAD_BATTERY = 2
 
+# sizes of the learned model, indexed by battery level and action;
+# the hash of a state is its battery level, so state hashes index it too
+N_STATES = 3
+N_ACTIONS = 3
+
+# actions allowed in each battery level, as in RobotState.get_valid_actions
+VALID_ACTIONS = np.array(
+    [[True, True, False], [True, True, True], [False, False, True]]
+)
+VALID_ACTION_LISTS = ([SEARCH, WAIT], [SEARCH, WAIT, RECHARGE], [RECHARGE])
+
 ALPHA = 0.5
 BETA = 0.5
 
@@ -35,16 +63,33 @@ DISCOUNT = 0.9
 PRINT_EVERY_N = 50
 MAX_STEPS = 100
 
+# probability of finding a can with each action
+REWARD_PROBS = np.array([REWARD_SEARCH, REWARD_WAIT, REWARD_RECHARGE])
+
+# value iteration over the learned model stops after this many sweeps,
+# or once no state value changes by more than the tolerance
+PLANNING_SWEEPS = 100
+PLANNING_TOLERANCE = 1e-6
+
+# stop_when_optimal stops once the greedy policy has been optimal, and the state
+# values within this tolerance of the optimal ones, for this many episodes in a row
+OPTIMAL_WINDOW = 100
+OPTIMAL_VALUE_TOLERANCE = 0.1
+
 
 class RobotState:
     """Robot state with battery level and random outcomes."""
 
-    def __init__(self, battery_level):
-        """Initialize state with battery level."""
+    def __init__(self, battery_level, rng=None, outcomes=True):
+        """Initialize state with battery level and outcomes drawn from @rng, unless not @outcomes."""
         self.battery_level = battery_level
         self.hash_val = None
-        self.deplete_rng = np.random.random()
-        self.reward_rng = np.random.random()
+        self.rng = RNG if rng is None else rng
+        if outcomes:
+            self.deplete_rng = self.rng.random()
+            self.reward_rng = self.rng.random()
+        else:
+            self.deplete_rng = self.reward_rng = None
 
     def hash(self):
         """Compute unique hash for the state."""
@@ -65,71 +110,135 @@ class RobotState:
 
     def next_state(self, action: Literal[0, 1, 2]):
         """Generate next state based on action and probabilities."""
-        if action == SEARCH:
-            if self.battery_level == HIGH_BATTERY:
-                if self.deplete_rng < ALPHA:
-                    new_state = RobotState(battery_level=HIGH_BATTERY)
-                else:
-                    new_state = RobotState(battery_level=LOW_BATTERY)
-            elif self.battery_level == LOW_BATTERY:
-                if self.deplete_rng < BETA:
-                    new_state = RobotState(battery_level=LOW_BATTERY)
-                else:
-                    new_state = RobotState(battery_level=DEAD_BATTERY)
-            elif self.battery_level == DEAD_BATTERY:
-                raise ValueError("Cannot search with dead battery")
+        return RobotState(
+            next_battery_level(self.battery_level, action, self.deplete_rng), self.rng
+        )
 
-        elif action == WAIT:
-            if self.battery_level == DEAD_BATTERY:
-                raise ValueError("Cannot wait with dead battery")
-            new_state = RobotState(battery_level=self.battery_level)
+    def get_reward(self, action: Literal[0, 1, 2]):
+        """Calculate reward for taking action in this state."""
+        return get_reward(self.battery_level, action, self.deplete_rng, self.reward_rng)
 
-        elif action == RECHARGE:
-            new_state = RobotState(battery_level=HIGH_BATTERY)
 
-        else:
-            raise ValueError("Invalid action")
+# one shared state per battery level, without outcomes, for the flyweight mode
+BATTERY_STATES = tuple(
+    RobotState(level, outcomes=False)
+    for level in (HIGH_BATTERY, LOW_BATTERY, DEAD_BATTERY)
+)
 
-        return new_state
 
-    def get_reward(self, action: Literal[0, 1, 2]):
-        """Calculate reward for taking action in this state."""
-        if action == SEARCH:
-            if self.battery_level == LOW_BATTERY and self.deplete_rng >= BETA:
-                return REWARD_DEAD_BATERY
-
-            if self.reward_rng < REWARD_SEARCH:
-                return 1
-            return 0
-
-        elif action == WAIT:
-            if self.reward_rng < REWARD_WAIT:
-                return 1
-            return 0
-
-        elif action == RECHARGE:
-            if self.reward_rng < REWARD_RECHARGE:
-                return 1
-            return 0
-        else:
+class MDPRobotState:
+    """State of a SparseMDP with its random outcome, the RobotState of MDPRobotAgent."""
+
+    def __init__(self, mdp, state, rng=None):
+        """Initialize state @state of @mdp with the uniform draw choosing its outcome from @rng."""
+        self.mdp = mdp
+        # the state index, named as RobotState so that RobotAgent.act works unchanged
+        self.battery_level = state
+        self.rng = RNG if rng is None else rng
+        self.outcome_rng = self.rng.random()
+
+    def hash(self):
+        """The state index."""
+        return self.battery_level
+
+    def get_valid_actions(self):
+        """Return valid actions of the state."""
+        return self.mdp.valid_action_lists[self.battery_level]
+
+    def outcome(self, action):
+        """Entry of the MDP that taking action results in."""
+        if not self.mdp.valid[self.battery_level, action]:
             raise ValueError("Invalid action")
+        return self.mdp.sample(self.battery_level, action, self.outcome_rng)
+
+    def next_state(self, action):
+        """Next state of taking action."""
+        return MDPRobotState(
+            self.mdp, self.mdp.next_states_list[self.outcome(action)], self.rng
+        )
+
+    def get_reward(self, action):
+        """Reward of taking action."""
+        return self.mdp.rewards_list[self.outcome(action)]
+
+
+def next_battery_level(battery_level, action, deplete_rng):
+    """Battery level after taking action, given the depletion outcome of the state."""
+    if action == SEARCH:
+        if battery_level == HIGH_BATTERY:
+            if deplete_rng < ALPHA:
+                return HIGH_BATTERY
+            return LOW_BATTERY
+        elif battery_level == LOW_BATTERY:
+            if deplete_rng < BETA:
+                return LOW_BATTERY
+            return DEAD_BATTERY
+        elif battery_level == DEAD_BATTERY:
+            raise ValueError("Cannot search with dead battery")
+
+    elif action == WAIT:
+        if battery_level == DEAD_BATTERY:
+            raise ValueError("Cannot wait with dead battery")
+        return battery_level
+
+    elif action == RECHARGE:
+        return HIGH_BATTERY
+
+    raise ValueError("Invalid action")
+
+
+def get_reward(battery_level, action, deplete_rng, reward_rng):
+    """Reward for taking action, given the depletion and reward outcomes of the state."""
+    if action == SEARCH:
+        if battery_level == LOW_BATTERY and deplete_rng >= BETA:
+            return REWARD_DEAD_BATERY
+
+        if reward_rng < REWARD_SEARCH:
+            return 1
+        return 0
+
+    elif action == WAIT:
+        if reward_rng < REWARD_WAIT:
+            return 1
+        return 0
+
+    elif action == RECHARGE:
+        if reward_rng < REWARD_RECHARGE:
+            return 1
+        return 0
+    else:
+        raise ValueError("Invalid action")
 
 
 class RobotAgent:
     """RL Agent using temporal difference learning with learned environment model."""
 
-    def __init__(self, step_size=0.1, epsilon=EPSILON, discount=DISCOUNT):
-        """Initialize agent with learning parameters."""
+    def __init__(self, step_size=0.1, epsilon=EPSILON, discount=DISCOUNT, rng=None):
+        """Initialize agent with learning parameters, exploring with @rng."""
         self.estimations = dict()
         self.step_size = step_size
         self.epsilon = epsilon
         self.discount = discount
+        self.rng = RNG if rng is None else rng
         self.states = []
         self.greedy = []
-
-        self.transition_counts = {}
-        self.reward_history = {}
-        self.total_attempts = {}
+        # the SparseMDP of an MDPRobotAgent, None for the three battery levels
+        self.mdp = None
+        self.valid_actions = VALID_ACTIONS
+        self.valid_action_lists = VALID_ACTION_LISTS
+
+        # learned model as running statistics, updated in O(1) per step
+        self.transition_counts = np.zeros((N_STATES, N_ACTIONS, N_STATES), np.int64)
+        self.total_attempts = np.zeros((N_STATES, N_ACTIONS), np.int64)
+        self.reward_sum = np.zeros((N_STATES, N_ACTIONS))
+        # sum of squared deviations from the mean reward (Welford)
+        self.reward_m2 = np.zeros((N_STATES, N_ACTIONS))
+
+        # held while the model or the estimations change, and for a whole
+        # plan(), so the planner sees a consistent model and no update is lost
+        self.lock = threading.Lock()
+        self.planner = None
+        self.stop_planner = threading.Event()
 
         self.estimations[hash(HIGH_BATTERY)] = 0.5
         self.estimations[hash(LOW_BATTERY)] = 0.5
@@ -147,119 +256,355 @@ class RobotAgent:
 
     def update_model(self, state, action, next_state, reward):
         """Update the learned environment model based on experience."""
-        state_hash = state.hash()
-        next_state_hash = next_state.hash()
-        key = (state_hash, action)
-
-        if key not in self.transition_counts:
-            self.transition_counts[key] = {}
-        if next_state_hash not in self.transition_counts[key]:
-            self.transition_counts[key][next_state_hash] = 0
-        self.transition_counts[key][next_state_hash] += 1
-
-        if key not in self.reward_history:
-            self.reward_history[key] = []
-
-        self.reward_history[key].append(reward)
-
-        self.total_attempts[key] = self.total_attempts.get(key, 0) + 1
+        self.update_model_levels(
+            state.battery_level, action, next_state.battery_level, reward
+        )
+
+    def update_model_levels(self, level, action, next_level, reward):
+        """Update the learned environment model with a transition between battery levels."""
+        if PROFILER.enabled:
+            start = perf_counter()
+        with self.lock:
+            self.transition_counts[level, action, next_level] += 1
+
+            count = self.total_attempts[level, action]
+            old_mean = self.reward_sum[level, action] / count if count else 0.0
+            self.total_attempts[level, action] = count + 1
+            self.reward_sum[level, action] += reward
+            new_mean = self.reward_sum[level, action] / (count + 1)
+            self.reward_m2[level, action] += (reward - old_mean) * (reward - new_mean)
+        if PROFILER.enabled:
+            PROFILER.add("RobotAgent.update_model", perf_counter() - start)
 
     def get_transition_prob(self, state_hash, action, next_state_hash):
         """Get learned transition probability."""
-        key = (state_hash, action)
-        if key not in self.transition_counts:
+        total = self.total_attempts[state_hash, action]
+        if total == 0:
             return 0.0
-
-        total = self.total_attempts[key]
-        count = self.transition_counts[key].get(next_state_hash, 0)
-        return count / total if total > 0 else 0.0
+        return self.transition_counts[state_hash, action, next_state_hash] / total
 
     def get_expected_reward(self, state_hash, action):
         """Get expected reward for state-action pair."""
-        key = (state_hash, action)
-        if key not in self.reward_history or len(self.reward_history[key]) == 0:
+        total = self.total_attempts[state_hash, action]
+        if total == 0:
+            return 0.0
+        return self.reward_sum[state_hash, action] / total
+
+    def get_reward_variance(self, state_hash, action):
+        """Get variance of the rewards seen for state-action pair."""
+        total = self.total_attempts[state_hash, action]
+        if total == 0:
             return 0.0
-        return np.mean(self.reward_history[key])
+        return self.reward_m2[state_hash, action] / total
+
+    def get_expected_values(self, state):
+        """Calculate expected value of every action using learned model, 0.5 for untried ones."""
+        return self.get_level_values(state.battery_level)
+
+    def get_level_values(self, level):
+        """Expected value of every action in a battery level, as get_expected_values."""
+        totals = self.total_attempts[level]
+        values = np.array([self.estimations.get(s, 0.0) for s in range(N_STATES)])
+        # probabilities of a tried action sum to 1, so its value is R + γ Σ p(s') V(s')
+        expected = (
+            self.reward_sum[level]
+            + self.discount * (self.transition_counts[level] @ values)
+        ) / np.maximum(totals, 1)
+        expected[totals == 0] = 0.5
+        return expected
 
     def get_expected_value(self, state, action):
         """Calculate expected value using learned model."""
-        state_hash = state.hash()
-        key = (state_hash, action)
-
-        if key not in self.total_attempts or self.total_attempts[key] == 0:
-            return 0.5
-
-        expected_value = 0.0
-        expected_reward = self.get_expected_reward(state_hash, action)
-
-        if key in self.transition_counts:
-            for next_state_hash, count in self.transition_counts[key].items():
-                prob = count / self.total_attempts[key]
-                next_state_value = self.estimations.get(next_state_hash, 0.0)
-                expected_value += prob * (
-                    expected_reward + self.discount * next_state_value
-                )
-
-        return expected_value
+        return self.get_expected_values(state)[action]
+
+    def get_expected_value_table(self):
+        """Expected value of every battery level and action, as get_expected_values of each state."""
+        totals = self.total_attempts
+        values = np.array([self.estimations.get(s, 0.0) for s in range(N_STATES)])
+        expected = (
+            self.reward_sum + self.discount * (self.transition_counts @ values)
+        ) / np.maximum(totals, 1)
+        expected[totals == 0] = 0.5
+        return expected
+
+    def get_state_values(self):
+        """Estimated value of every battery level as an array."""
+        return np.array([self.estimations.get(s, 0.0) for s in range(N_STATES)])
+
+    def greedy_policy(self):
+        """Action choose_action takes in every battery level when it does not explore."""
+        table = np.where(self.valid_actions, self.get_expected_value_table(), -np.inf)
+        # the first valid action of highest value, as choose_action
+        return table.argmax(axis=1)
+
+    def update_model_batch(self, levels, actions, next_levels, rewards):
+        """Update the learned environment model with arrays of transitions at once."""
+        pairs = levels * N_ACTIONS + actions
+        size = N_STATES * N_ACTIONS
+        counts = np.bincount(pairs, minlength=size).reshape(N_STATES, N_ACTIONS)
+        sums = np.bincount(pairs, rewards, minlength=size).reshape(N_STATES, N_ACTIONS)
+        means = sums / np.maximum(counts, 1)
+        deviations = rewards - means.reshape(-1)[pairs]
+        m2 = np.bincount(pairs, deviations**2, minlength=size).reshape(
+            N_STATES, N_ACTIONS
+        )
+        with self.lock:
+            np.add.at(self.transition_counts, (levels, actions, next_levels), 1)
+            # merge the batch statistics into the running ones (Chan et al.)
+            totals = self.total_attempts + counts
+            delta = means - self.reward_sum / np.maximum(self.total_attempts, 1)
+            self.reward_m2 += m2 + delta**2 * self.total_attempts * counts / np.maximum(
+                totals, 1
+            )
+            self.total_attempts = totals
+            self.reward_sum += sums
 
     def backup(self, episode_reward_history):
         """Update state values using temporal difference learning."""
+        profile = PROFILER.enabled
+        if profile:
+            start = perf_counter()
         states = [state.hash() for state in self.states]
-
-        for i in reversed(range(len(states) - 1)):
-            state_hash = states[i]
-            next_state_hash = states[i + 1]
-            reward = episode_reward_history[i]
-
-            td_error = self.greedy[i] * (
-                reward
-                + self.discount * self.estimations[next_state_hash]
-                - self.estimations[state_hash]
-            )  # V(s) = R + γV(s')
-            self.estimations[state_hash] += self.step_size * td_error
+        if profile:
+            update = perf_counter()
+            PROFILER.add("RobotAgent.backup/hash", update - start)
+
+        with self.lock:
+            for i in reversed(range(len(states) - 1)):
+                state_hash = states[i]
+                next_state_hash = states[i + 1]
+                reward = episode_reward_history[i]
+
+                td_error = self.greedy[i] * (
+                    reward
+                    + self.discount * self.estimations[next_state_hash]
+                    - self.estimations[state_hash]
+                )  # V(s) = R + γV(s')
+                self.estimations[state_hash] += self.step_size * td_error
+        if profile:
+            PROFILER.add("RobotAgent.backup/update", perf_counter() - update)
+
+    def backup_levels(self, levels, rewards, greedy, steps):
+        """Update state values from the first @steps steps of a trajectory of battery levels, as backup."""
+        with self.lock:
+            for i in reversed(range(steps)):
+                td_error = greedy[i] * (
+                    rewards[i]
+                    + self.discount * self.estimations[levels[i + 1]]
+                    - self.estimations[levels[i]]
+                )  # V(s) = R + γV(s')
+                self.estimations[levels[i]] += self.step_size * td_error
+
+    def backup_batch(self, levels, rewards, greedy):
+        """Update state values from the episodes of many robots, as backup does for one.
+
+        levels holds the battery level of each robot at every step and after
+        the last one, rewards and greedy the reward and greediness of each
+        action. Going backwards one step at a time, the n greedy transitions
+        from a state move its value towards their mean target at the rate
+        1 - (1 - step_size) ** n of n updates with the same target.
+        """
+        with self.lock:
+            values = self.get_state_values()
+            n_states = len(values)
+            for step in reversed(range(rewards.shape[1])):
+                moved = greedy[:, step]
+                states = levels[moved, step]
+                targets = (
+                    rewards[moved, step]
+                    + self.discount * values[levels[moved, step + 1]]
+                )
+                counts = np.bincount(states, minlength=n_states)
+                sums = np.bincount(states, targets, minlength=n_states)
+                updated = counts > 0
+                rate = 1 - (1 - self.step_size) ** counts[updated]
+                values[updated] += rate * (
+                    sums[updated] / counts[updated] - values[updated]
+                )
+            for s in range(n_states):
+                self.estimations[s] = float(values[s])
+
+    def plan(self, sweeps=PLANNING_SWEEPS, tolerance=PLANNING_TOLERANCE):
+        """Run value iteration over the learned model and store the values, return the sweeps run."""
+        profile = PROFILER.enabled
+        if profile:
+            start = perf_counter()
+        # the lock is held from reading the values to storing them, a TD update
+        # in between would be overwritten; a 3-state run takes tens of microseconds
+        with self.lock:
+            counts = self.transition_counts.astype(np.float64)
+            totals = self.total_attempts.copy()
+            reward_sum = self.reward_sum.copy()
+            values = self.get_state_values()
+            tried = VALID_ACTIONS & (totals > 0)
+            planned = tried.any(axis=1)
+            if not planned.any():
+                return 0
+            divisor = np.maximum(totals, 1)
+            probs = counts / divisor[:, :, np.newaxis]
+            rewards = reward_sum / divisor
+
+            for sweep in range(1, sweeps + 1):
+                # V(s) = max_a R(s, a) + γ Σ p(s'|s, a) V(s'), over the tried actions
+                q_values = np.where(
+                    tried, rewards + self.discount * (probs @ values), -np.inf
+                )
+                new_values = np.where(planned, q_values.max(axis=1), values)
+                change = np.abs(new_values - values).max()
+                values = new_values
+                if change < tolerance:
+                    break
+
+            for s in np.flatnonzero(planned).tolist():
+                self.estimations[s] = float(values[s])
+        if profile:
+            PROFILER.add("RobotAgent.plan", perf_counter() - start, sweep)
+        return sweep
+
+    def start_planning(self, interval=0.01):
+        """Keep running plan() in a background thread, pausing @interval seconds between runs."""
+        if self.planner is not None:
+            return
+        self.stop_planner.clear()
+
+        def run():
+            while not self.stop_planner.wait(interval):
+                self.plan()
+
+        self.planner = threading.Thread(target=run, name="RobotAgent.plan", daemon=True)
+        self.planner.start()
+
+    def stop_planning(self):
+        """Stop the background planner and wait for its last run to finish."""
+        if self.planner is None:
+            return
+        self.stop_planner.set()
+        self.planner.join()
+        self.planner = None
 
     def act(self):
         """Choose action using epsilon-greedy policy."""
-        state = self.states[-1]
-        valid_actions = state.get_valid_actions()
-
-        if np.random.rand() < self.epsilon:
-            random_action = np.random.choice(valid_actions)
-            self.greedy[-1] = False
-            return random_action
-
+        action, self.greedy[-1] = self.choose_action(self.states[-1].battery_level)
+        return action
+
+    def choose_action(self, level):
+        """Epsilon-greedy action in a battery level, and whether it was greedy."""
+        profile = PROFILER.enabled
+        if profile:
+            start = perf_counter()
+        valid_actions = self.valid_action_lists[level]
+
+        if self.rng.random() < self.epsilon:
+            random_action = self.rng.choice(valid_actions)
+            if profile:
+                PROFILER.add("RobotAgent.act/explore", perf_counter() - start)
+            return random_action, False
+
+        values = self.get_level_values(level).tolist()
         best_action = valid_actions[0]  # updated if better action exists
-        best_value = self.get_expected_value(state, best_action)
+        best_value = values[best_action]
 
         for action in valid_actions[1:]:
-            value = self.get_expected_value(state, action)
+            value = values[action]
             if value > best_value:
                 best_value = value
                 best_action = action
 
-        return best_action
+        if profile:
+            PROFILER.add("RobotAgent.act/expected_value", perf_counter() - start)
+        return best_action, True
+
+    def snapshot(self):
+        """Copy of the estimations and the learned model, as saved by save_policy."""
+        with self.lock:
+            return {
+                "estimations": dict(self.estimations),
+                "transition_counts": self.transition_counts.copy(),
+                "total_attempts": self.total_attempts.copy(),
+                "reward_sum": self.reward_sum.copy(),
+                "reward_m2": self.reward_m2.copy(),
+            }
+
+    def restore(self, data):
+        """Take the estimations and the learned model of a snapshot or policy file."""
+        with self.lock:
+            self.estimations = data["estimations"]
+            if "reward_history" in data:
+                self.load_model_history(data)
+            else:
+                self.transition_counts = data["transition_counts"]
+                self.total_attempts = data["total_attempts"]
+                self.reward_sum = data["reward_sum"]
+                self.reward_m2 = data["reward_m2"]
 
     def save_policy(self):
         with open("robot_policy.bin", "wb") as f:
-            data = {
-                "estimations": self.estimations,
-                "transition_counts": self.transition_counts,
-                "reward_history": self.reward_history,
-                "total_attempts": self.total_attempts,
-            }
-            pickle.dump(data, f)
+            pickle.dump(self.snapshot(), f)
 
     def load_policy(self):
         try:
             with open("robot_policy.bin", "rb") as f:
                 data = pickle.load(f)
-                self.estimations = data["estimations"]
-                self.transition_counts = data["transition_counts"]
-                self.reward_history = data["reward_history"]
-                self.total_attempts = data["total_attempts"]
+            self.restore(data)
         except FileNotFoundError:
             print("Policy file not found. Starting with fresh policy.")
 
+    def load_model_history(self, data):
+        """Rebuild the model statistics from the dicts and reward lists of old policy files."""
+        for (state_hash, action), counts in data["transition_counts"].items():
+            for next_state_hash, count in counts.items():
+                self.transition_counts[state_hash, action, next_state_hash] = count
+        for (state_hash, action), rewards in data["reward_history"].items():
+            self.total_attempts[state_hash, action] = len(rewards)
+            self.reward_sum[state_hash, action] = np.sum(rewards)
+            self.reward_m2[state_hash, action] = np.var(rewards) * len(rewards)
+
+    def reset_model(self):
+        """Forget the learned model."""
+        with self.lock:
+            self.transition_counts = np.zeros_like(self.transition_counts)
+            self.total_attempts = np.zeros_like(self.total_attempts)
+            self.reward_sum = np.zeros_like(self.reward_sum)
+            self.reward_m2 = np.zeros_like(self.reward_m2)
+
+    def rebuild_model(self, path, chunk_size=CHUNK_SIZE):
+        """Replace the learned model by the one of the transitions in the experience log at path."""
+        self.reset_model()
+        for chunk in chunks(path, chunk_size):
+            self.update_model_batch(
+                chunk["state"].astype(np.intp),
+                chunk["action"].astype(np.intp),
+                chunk["next_state"].astype(np.intp),
+                chunk["reward"].astype(np.float64),
+            )
+
+    def replay(self, path, chunk_size=CHUNK_SIZE):
+        """Update the state values with every transition of the experience log at path, in order."""
+        for chunk in chunks(path, chunk_size):
+            self.replay_transitions(
+                chunk["state"].tolist(),
+                chunk["reward"].tolist(),
+                chunk["next_state"].tolist(),
+                chunk["greedy"].tolist(),
+            )
+
+    def replay_transitions(self, states, rewards, next_states, greedy):
+        """Temporal difference update of the state values with each transition, as backup."""
+        estimations = self.estimations
+        with self.lock:
+            for state, reward, next_state, weight in zip(
+                states, rewards, next_states, greedy
+            ):
+                estimations[state] += (
+                    self.step_size
+                    * weight
+                    * (
+                        reward
+                        + self.discount * estimations[next_state]
+                        - estimations[state]
+                    )
+                )
+
     def print_policy(self):
         """Print current policy for each state."""
         battery_names = {HIGH_BATTERY: "HIGH", LOW_BATTERY: "LOW", DEAD_BATTERY: "DEAD"}
@@ -269,20 +614,19 @@ class RobotAgent:
         print("------|--------|--------|----------")
 
         for battery_level in [HIGH_BATTERY, LOW_BATTERY, DEAD_BATTERY]:
-            state = RobotState(battery_level=battery_level)
+            state = BATTERY_STATES[battery_level]
             valid_actions = state.get_valid_actions()
             if not valid_actions:
                 continue
 
-            best_action = max(
-                valid_actions, key=lambda a: self.get_expected_value(state, a)
-            )
+            values = self.get_expected_values(state)
+            best_action = max(valid_actions, key=lambda a: values[a])
 
             row = f"{battery_names[battery_level]:5} |"
 
             for action in [SEARCH, WAIT, RECHARGE]:
                 if action in valid_actions:
-                    value = self.get_expected_value(state, action)
+                    value = values[action]
                     marker = "*" if action == best_action else " "
                     row += f" {value:5.2f}{marker} |"
                 else:
@@ -291,35 +635,332 @@ class RobotAgent:
             print(row)
 
 
+class MDPRobotAgent(RobotAgent):
+    """RobotAgent of the states and actions of a SparseMDP.
+
+    Its learned model counts how often each outcome of the MDP's CSR table
+    happened, so its memory and the cost of an action value scale with the
+    number of nonzero transitions. The estimations are an array indexed by
+    state, the battery level arguments of RobotAgent methods are states.
+    """
+
+    def __init__(
+        self, mdp, step_size=0.1, epsilon=EPSILON, discount=DISCOUNT, rng=None
+    ):
+        super().__init__(step_size, epsilon, discount, rng)
+        self.mdp = mdp
+        self.valid_actions = mdp.valid
+        self.valid_action_lists = mdp.valid_action_lists
+        self.estimations = np.full(mdp.n_states, 0.5)
+        self.outcome_counts = np.zeros(mdp.nnz, np.int64)
+        self.total_attempts = np.zeros((mdp.n_states, mdp.n_actions), np.int64)
+        self.transition_counts = self.reward_sum = self.reward_m2 = None
+
+    def update_model_outcome(self, state, action, outcome):
+        """Count outcome, an entry of the MDP, as the result of action in state."""
+        with self.lock:
+            self.outcome_counts[outcome] += 1
+            self.total_attempts[state, action] += 1
+
+    def update_model(self, state, action, next_state, reward):
+        """Update the learned model with the outcome of an MDPRobotState."""
+        self.update_model_outcome(state.battery_level, action, state.outcome(action))
+
+    def update_model_levels(self, state, action, next_state, reward):
+        """Update the learned model with a transition, matched to its outcome of the MDP."""
+        self.update_model_batch(
+            np.array([state]),
+            np.array([action]),
+            np.array([next_state]),
+            np.array([reward]),
+        )
+
+    def row_slice(self, state, action):
+        """Entries of the MDP that are the outcomes of action in state."""
+        row = state * self.mdp.n_actions + action
+        return slice(self.mdp.indptr[row], self.mdp.indptr[row + 1])
+
+    def get_transition_prob(self, state, action, next_state):
+        """Get learned transition probability."""
+        total = self.total_attempts[state, action]
+        if total == 0:
+            return 0.0
+        entries = self.row_slice(state, action)
+        hits = self.mdp.next_states[entries] == next_state
+        return self.outcome_counts[entries][hits].sum() / total
+
+    def get_expected_reward(self, state, action):
+        """Get expected reward for state-action pair."""
+        total = self.total_attempts[state, action]
+        if total == 0:
+            return 0.0
+        entries = self.row_slice(state, action)
+        return self.outcome_counts[entries] @ self.mdp.rewards[entries] / total
+
+    def get_reward_variance(self, state, action):
+        """Get variance of the rewards seen for state-action pair."""
+        total = self.total_attempts[state, action]
+        if total == 0:
+            return 0.0
+        entries = self.row_slice(state, action)
+        rewards = self.mdp.rewards[entries]
+        mean = self.get_expected_reward(state, action)
+        return self.outcome_counts[entries] @ (rewards - mean) ** 2 / total
+
+    def load_model_history(self, data):
+        raise ValueError("Old policy files only hold the three battery levels")
+
+    def get_level_values(self, state):
+        """Expected value of every action in state, 0.5 for untried ones."""
+        mdp = self.mdp
+        start = mdp.indptr[state * mdp.n_actions]
+        end = mdp.indptr[(state + 1) * mdp.n_actions]
+        sums = np.bincount(
+            mdp.entry_actions[start:end],
+            self.outcome_counts[start:end]
+            * (
+                mdp.rewards[start:end]
+                + self.discount * self.estimations[mdp.next_states[start:end]]
+            ),
+            minlength=mdp.n_actions,
+        )
+        totals = self.total_attempts[state]
+        expected = sums / np.maximum(totals, 1)
+        expected[totals == 0] = 0.5
+        return expected
+
+    def get_state_values(self):
+        """Estimated value of every state."""
+        return self.estimations.copy()
+
+    def reset_model(self):
+        """Forget the learned model."""
+        with self.lock:
+            self.outcome_counts = np.zeros_like(self.outcome_counts)
+            self.total_attempts = np.zeros_like(self.total_attempts)
+
+    def update_model_batch(self, states, actions, next_states, rewards):
+        """Count arrays of transitions at once, each as the outcome of the MDP it matches."""
+        mdp = self.mdp
+        rows = states * mdp.n_actions + actions
+        starts = mdp.indptr[rows]
+        ends = mdp.indptr[rows + 1]
+        # the rewards of the log are float32, so are the ones they are compared to
+        outcome_rewards = mdp.rewards.astype(np.float32)
+        rewards = rewards.astype(np.float32)
+        outcomes = np.full(len(rows), -1)
+        for k in range(int((ends - starts).max(initial=0))):
+            entries = np.minimum(starts + k, mdp.nnz - 1)
+            match = (
+                (outcomes < 0)
+                & (starts + k < ends)
+                & (mdp.next_states[entries] == next_states)
+                & (outcome_rewards[entries] == rewards)
+            )
+            outcomes[match] = entries[match]
+        if (outcomes < 0).any():
+            raise ValueError("A transition is not an outcome of the MDP")
+        with self.lock:
+            self.outcome_counts += np.bincount(outcomes, minlength=mdp.nnz)
+            np.add.at(self.total_attempts, (states, actions), 1)
+
+    def learned_probs(self, counts, totals):
+        """Probability of every outcome of the MDP under the learned model."""
+        return counts / np.maximum(totals.reshape(-1), 1)[self.mdp.entry_rows]
+
+    def get_expected_value_table(self):
+        """Expected value of every state and action, 0.5 for untried ones."""
+        table = self.mdp.action_values(
+            self.estimations,
+            self.discount,
+            self.learned_probs(self.outcome_counts, self.total_attempts),
+        )
+        table[self.total_attempts == 0] = 0.5
+        return table
+
+    def plan(self, sweeps=PLANNING_SWEEPS, tolerance=PLANNING_TOLERANCE):
+        """Run value iteration over the learned model and store the values, return the sweeps run."""
+        # held for the whole run, as in RobotAgent.plan
+        with self.lock:
+            counts = self.outcome_counts.copy()
+            totals = self.total_attempts.copy()
+            values = self.estimations.copy()
+            tried = self.mdp.valid & (totals > 0)
+            planned = tried.any(axis=1)
+            if not planned.any():
+                return 0
+            probs = self.learned_probs(counts, totals)
+
+            for sweep in range(1, sweeps + 1):
+                q_values = self.mdp.action_values(values, self.discount, probs)
+                q_values[~tried] = -np.inf
+                new_values = np.where(planned, q_values.max(axis=1), values)
+                change = np.abs(new_values - values).max()
+                values = new_values
+                if change < tolerance:
+                    break
+
+            self.estimations[planned] = values[planned]
+        return sweep
+
+    def policy_path(self):
+        return f"robot_policy_{self.mdp.n_states}x{self.mdp.n_actions}.bin"
+
+    def snapshot(self):
+        """Copy of the estimations and the learned model, as saved by save_policy."""
+        with self.lock:
+            return {
+                "estimations": self.estimations.copy(),
+                "outcome_counts": self.outcome_counts.copy(),
+                "total_attempts": self.total_attempts.copy(),
+            }
+
+    def restore(self, data):
+        """Take the estimations and the learned model of a snapshot or policy file."""
+        with self.lock:
+            self.estimations = data["estimations"]
+            self.outcome_counts = data["outcome_counts"]
+            self.total_attempts = data["total_attempts"]
+
+    def save_policy(self):
+        with open(self.policy_path(), "wb") as f:
+            pickle.dump(self.snapshot(), f)
+
+    def load_policy(self):
+        try:
+            with open(self.policy_path(), "rb") as f:
+                data = pickle.load(f)
+            self.restore(data)
+        except FileNotFoundError:
+            print("Policy file not found. Starting with fresh policy.")
+
+    def print_policy(self):
+        """Print how many visited states choose each action."""
+        visited = self.total_attempts.sum(axis=1) > 0
+        actions = np.bincount(
+            self.greedy_policy()[visited], minlength=self.mdp.n_actions
+        )
+        print(
+            f"{visited.sum()} of {self.mdp.n_states} states visited, greedy actions: "
+            + ", ".join(f"{action}: {count}" for action, count in enumerate(actions))
+        )
+
+
+# SparseMDP of robots with @levels battery levels on a @width x @height grid
+# of cells where SEARCH finds a can with the probability @can_probs[y][x].
+def make_robot_mdp(levels=3, width=1, height=1, can_probs=None):
+    """Robot MDP generalizing the three battery levels, the default is exactly that MDP.
+
+    State (depletion * width * height + cell) has depletion 0 for a full
+    battery and levels - 1 for a dead one. SEARCH and the MOVES keep the
+    battery with probability ALPHA, or BETA on the last level before dead,
+    and running it down to dead costs REWARD_DEAD_BATERY. WAIT keeps the
+    level, RECHARGE fills the battery where the robot stands, and the MOVES
+    exist only on grids of more than one cell.
+    """
+    cells = width * height
+    if can_probs is None:
+        can_probs = np.full((height, width), REWARD_SEARCH)
+    can_probs = np.asarray(can_probs, dtype=np.float64).reshape(-1)
+    n_actions = RECHARGE + 1 if cells == 1 else RECHARGE + 1 + len(MOVES)
+    dead = levels - 1
+    outcomes = {}
+    for depletion in range(levels):
+        keep = BETA if depletion == dead - 1 else ALPHA
+        for cell in range(cells):
+            state = depletion * cells + cell
+            x, y = cell % width, cell // width
+            if depletion > 0:
+                outcomes[state, RECHARGE] = [
+                    (cell, 1, REWARD_RECHARGE),
+                    (cell, 0, 1 - REWARD_RECHARGE),
+                ]
+            if depletion == dead:
+                continue
+            outcomes[state, WAIT] = [
+                (state, 1, REWARD_WAIT),
+                (state, 0, 1 - REWARD_WAIT),
+            ]
+            # the next state and reward of draining the battery by one level
+            drained = state + cells
+            found = can_probs[cell]
+            if depletion + 1 == dead:
+                drained_outcomes = [(drained, REWARD_DEAD_BATERY, 1 - keep)]
+            else:
+                drained_outcomes = [
+                    (drained, 1, (1 - keep) * found),
+                    (drained, 0, (1 - keep) * (1 - found)),
+                ]
+            outcomes[state, SEARCH] = [
+                (state, 1, keep * found),
+                (state, 0, keep * (1 - found)),
+            ] + drained_outcomes
+            if cells == 1:
+                continue
+            for move, (dx, dy) in MOVES.items():
+                if 0 <= x + dx < width and 0 <= y + dy < height:
+                    target = depletion * cells + (y + dy) * width + x + dx
+                    if depletion + 1 == dead:
+                        drained_outcome = (target + cells, REWARD_DEAD_BATERY, 1 - keep)
+                    else:
+                        drained_outcome = (target + cells, 0, 1 - keep)
+                    outcomes[state, move] = [(target, 0, keep), drained_outcome]
+    return SparseMDP.from_outcomes(levels * cells, n_actions, outcomes)
+
+
 class CanCollectionJudger:
-    """Manages game flow and coordinates agent-environment interaction."""
+    """Manages game flow and coordinates agent-environment interaction.
+
+    With an MDPRobotAgent, the robot moves between the MDPRobotStates of
+    its SparseMDP instead of the three battery levels.
+    """
 
     def __init__(self, agent):
         self.agent = agent
+        # the environment draws its outcomes from the stream of the agent
+        self.rng = agent.rng
         self.current_state = None
         self.total_episode_reward = 0
         self.steps = 0
         self.max_steps = MAX_STEPS
+        # actions and rewards of the episode, the states are in agent.states
+        self.actions = []
+        self.rewards = []
 
     def reset(self):
         """Reset environment for new episode."""
         self.agent.reset()
-        self.current_state = RobotState(battery_level=HIGH_BATTERY)
+        mdp = self.agent.mdp
+        if mdp is None:
+            self.current_state = RobotState(HIGH_BATTERY, self.rng)
+        else:
+            self.current_state = MDPRobotState(mdp, mdp.initial_state, self.rng)
         self.agent.set_state(self.current_state)
         self.total_episode_reward = 0
         self.steps = 0
+        self.actions = []
+        self.rewards = []
 
     def play_episode(self):
         """Play complete episode and return rewards."""
         self.reset()
         episode_reward_history = []
+        profile = PROFILER.enabled
 
         while self.steps < self.max_steps:
             action = self.agent.act()
 
+            if profile:
+                start = perf_counter()
             reward = self.current_state.get_reward(action)
+            if profile:
+                transition = perf_counter()
+                PROFILER.add("play_episode/reward", transition - start)
             next_state = self.current_state.next_state(action)
+            if profile:
+                PROFILER.add("play_episode/next_state", perf_counter() - transition)
             episode_reward_history.append(reward)
+            self.actions.append(action)
 
             self.agent.update_model(self.current_state, action, next_state, reward)
 
@@ -329,39 +970,508 @@ class CanCollectionJudger:
             self.total_episode_reward += reward
             self.steps += 1
 
+        if profile:
+            PROFILER.count("play_episode/episodes")
+        self.rewards = episode_reward_history
         return self.total_episode_reward, episode_reward_history
 
+    def trajectory(self):
+        """States and actions of the last play_episode."""
+        return [state.battery_level for state in self.agent.states[:-1]], self.actions
 
-def train(epochs, print_every_n=PRINT_EVERY_N):
-    """Train robot agent using temporal difference learning."""
-    agent = RobotAgent(epsilon=EPSILON)
-    judger = CanCollectionJudger(agent)
+    def transitions(self):
+        """States, actions, greediness, rewards and next states of the last play_episode."""
+        levels = [state.battery_level for state in self.agent.states]
+        return (
+            levels[:-1],
+            self.actions,
+            self.agent.greedy[:-1],
+            self.rewards,
+            levels[1:],
+        )
 
-    episode_total_reward_history = []
 
-    for i in range(1, epochs + 1):
-        episode_total_reward, episode_individual_reward_history = judger.play_episode()
-        episode_total_reward_history.append(episode_total_reward)
+class FlyweightCanCollectionJudger:
+    """Plays episodes like CanCollectionJudger, without allocating a state per step.
 
-        agent.backup(episode_individual_reward_history)
+    The robot moves between the three BATTERY_STATES, the outcomes of each
+    step are drawn separately in the same order as RobotState would draw
+    them, and the trajectory is recorded in arrays allocated once. With an
+    MDPRobotAgent, the robot moves between the states of its SparseMDP
+    instead, one draw choosing the outcome of each step.
+    """
 
-        if i % print_every_n == 0:
-            avg_reward = (
-                sum(episode_total_reward_history[-print_every_n:]) / print_every_n
+    def __init__(self, agent):
+        self.agent = agent
+        # the environment draws its outcomes from the stream of the agent
+        self.rng = agent.rng
+        self.max_steps = MAX_STEPS
+        # trajectory of the last episode
+        self.levels = array("q", bytes(8 * (self.max_steps + 1)))
+        self.actions = array("q", bytes(8 * self.max_steps))
+        self.rewards = array("d", bytes(8 * self.max_steps))
+        self.greedy = array("b", bytes(self.max_steps))
+        self.steps = 0
+
+    def play_episode(self):
+        """Play complete episode and return its total reward and the reward array."""
+        if self.agent.mdp is not None:
+            return self.play_mdp_episode()
+        agent = self.agent
+        random = self.rng.random
+        levels, actions, rewards, greedy = (
+            self.levels,
+            self.actions,
+            self.rewards,
+            self.greedy,
+        )
+        level = HIGH_BATTERY
+        deplete_rng = random()
+        reward_rng = random()
+        levels[0] = level
+        total_reward = 0
+
+        for step in range(self.max_steps):
+            action, greedy[step] = agent.choose_action(level)
+            reward = get_reward(level, action, deplete_rng, reward_rng)
+            next_level = next_battery_level(level, action, deplete_rng)
+            # outcomes of the next state
+            deplete_rng = random()
+            reward_rng = random()
+            agent.update_model_levels(level, action, next_level, reward)
+
+            actions[step] = action
+            rewards[step] = reward
+            levels[step + 1] = next_level
+            total_reward += reward
+            level = next_level
+
+        self.steps = self.max_steps
+        if PROFILER.enabled:
+            PROFILER.count("play_episode/episodes")
+        return total_reward, rewards
+
+    def play_mdp_episode(self):
+        """play_episode() on the SparseMDP of the agent."""
+        agent = self.agent
+        mdp = agent.mdp
+        random = self.rng.random
+        next_states = mdp.next_states_list
+        outcome_rewards = mdp.rewards_list
+        levels, actions, rewards, greedy = (
+            self.levels,
+            self.actions,
+            self.rewards,
+            self.greedy,
+        )
+        state = mdp.initial_state
+        levels[0] = state
+        total_reward = 0
+
+        for step in range(self.max_steps):
+            action, greedy[step] = agent.choose_action(state)
+            outcome = mdp.sample(state, action, random())
+            agent.update_model_outcome(state, action, outcome)
+            reward = outcome_rewards[outcome]
+
+            actions[step] = action
+            rewards[step] = reward
+            state = next_states[outcome]
+            levels[step + 1] = state
+            total_reward += reward
+
+        self.steps = self.max_steps
+        if PROFILER.enabled:
+            PROFILER.count("play_episode/episodes")
+        return total_reward, rewards
+
+    def backup(self):
+        """Update the agent from the trajectory of the last play_episode."""
+        self.agent.backup_levels(self.levels, self.rewards, self.greedy, self.steps)
+
+    def trajectory(self):
+        """States and actions of the last play_episode."""
+        return self.levels[: self.steps], self.actions[: self.steps]
+
+    def transitions(self):
+        """States, actions, greediness, rewards and next states of the last play_episode."""
+        steps = self.steps
+        levels = np.frombuffer(self.levels, np.int64)
+        return (
+            levels[:steps],
+            np.frombuffer(self.actions, np.int64)[:steps],
+            np.frombuffer(self.greedy, np.int8)[:steps],
+            np.frombuffer(self.rewards, np.float64)[:steps],
+            levels[1 : steps + 1],
+        )
+
+
+def step_batch(levels, actions, deplete_rngs, reward_rngs):
+    """Next battery levels and rewards of arrays of robots, as RobotState.next_state and get_reward."""
+    if not VALID_ACTIONS[levels, actions].all():
+        raise ValueError("Invalid action")
+    search = actions == SEARCH
+    next_levels = np.select(
+        [
+            search & (levels == HIGH_BATTERY),
+            search & (levels == LOW_BATTERY),
+            actions == WAIT,
+        ],
+        [
+            np.where(deplete_rngs < ALPHA, HIGH_BATTERY, LOW_BATTERY),
+            np.where(deplete_rngs < BETA, LOW_BATTERY, DEAD_BATTERY),
+            levels,
+        ],
+        HIGH_BATTERY,
+    )
+    rewards = (reward_rngs < REWARD_PROBS[actions]).astype(np.float64)
+    rewards[search & (levels == LOW_BATTERY) & (deplete_rngs >= BETA)] = (
+        REWARD_DEAD_BATERY
+    )
+    return next_levels, rewards
+
+
+class BatchCanCollectionJudger:
+    """Plays the episodes of many robots at once on arrays of battery levels."""
+
+    def __init__(self, agents, robots=1024):
+        """Robot i is driven by agents[i % len(agents)], agents may also be one shared agent."""
+        self.agents = agents if isinstance(agents, list) else [agents]
+        if any(agent.mdp is not None for agent in self.agents):
+            raise ValueError(
+                "BatchCanCollectionJudger only plays the three battery levels,"
+                " use a FlyweightCanCollectionJudger for an MDPRobotAgent"
             )
-            print(f"\nEpoch {i}: Average reward = {avg_reward:.2f}")
-            print(
-                f"State Values: HIGH={agent.estimations.get(hash(HIGH_BATTERY), 0):.3f}, LOW={agent.estimations.get(hash(LOW_BATTERY), 0):.3f}, DEAD={agent.estimations.get(hash(DEAD_BATTERY), 0):.3f}"
+        self.robots = robots
+        self.max_steps = MAX_STEPS
+        # the environment draws its outcomes from the stream of the first agent
+        self.rng = self.agents[0].rng
+        agent_ids = np.arange(robots) % len(self.agents)
+        self.robot_ids = [
+            np.flatnonzero(agent_ids == k) for k in range(len(self.agents))
+        ]
+        # trajectories of the last episode, one row per robot
+        self.levels = None
+        self.actions = None
+        self.rewards = None
+        self.greedy = None
+
+    def act(self, levels):
+        """Epsilon-greedy action of every robot, and whether it was greedy."""
+        actions = np.empty(self.robots, dtype=np.intp)
+        greedy = np.empty(self.robots, dtype=bool)
+        valid = VALID_ACTIONS[levels]
+        # a random valid action per robot, used where it explores
+        keys = self.rng.generator.random((self.robots, N_ACTIONS))
+        keys[~valid] = -1
+        random_actions = keys.argmax(axis=1)
+        explore_rngs = self.rng.generator.random(self.robots)
+        for agent, ids in zip(self.agents, self.robot_ids):
+            best_actions = agent.greedy_policy()
+            explore = explore_rngs[ids] < agent.epsilon
+            actions[ids] = np.where(
+                explore, random_actions[ids], best_actions[levels[ids]]
             )
+            greedy[ids] = ~explore
+        return actions, greedy
+
+    def play_episode(self):
+        """Play an episode of every robot, updating the models, and return their total rewards."""
+        self.levels = np.empty((self.robots, self.max_steps + 1), dtype=np.intp)
+        self.actions = np.empty((self.robots, self.max_steps), dtype=np.intp)
+        self.rewards = np.empty((self.robots, self.max_steps))
+        self.greedy = np.empty((self.robots, self.max_steps), dtype=bool)
+        levels = np.full(self.robots, HIGH_BATTERY, dtype=np.intp)
+        self.levels[:, 0] = levels
+        for step in range(self.max_steps):
+            actions, greedy = self.act(levels)
+            deplete_rngs, reward_rngs = self.rng.generator.random((2, self.robots))
+            next_levels, rewards = step_batch(
+                levels, actions, deplete_rngs, reward_rngs
+            )
+            for agent, ids in zip(self.agents, self.robot_ids):
+                agent.update_model_batch(
+                    levels[ids], actions[ids], next_levels[ids], rewards[ids]
+                )
+            self.actions[:, step] = actions
+            self.rewards[:, step] = rewards
+            self.greedy[:, step] = greedy
+            self.levels[:, step + 1] = next_levels
+            levels = next_levels
+        return self.rewards.sum(axis=1)
+
+    def backup(self):
+        """Update every agent from the episodes of its robots in the last play_episode."""
+        for agent, ids in zip(self.agents, self.robot_ids):
+            agent.backup_batch(self.levels[ids], self.rewards[ids], self.greedy[ids])
+
+
+class OptimalBaseline:
+    """Optimal values and policy of the known model, to measure an agent against.
+
+    The ground truth is solved with the real ALPHA, BETA and REWARD_*
+    parameters rather than learned, by value or policy iteration over the
+    SparseMDP of make_robot_mdp(), or over the MDP of an MDPRobotAgent.
+    """
+
+    def __init__(self, mdp=None, discount=DISCOUNT, method="value"):
+        """Solve @mdp, the three battery levels by default, with @method "value" or "policy" iteration."""
+        self.mdp = make_robot_mdp() if mdp is None else mdp
+        if method == "value":
+            self.values, self.policy = self.mdp.solve(discount)
+        elif method == "policy":
+            self.values, self.policy = self.mdp.policy_iteration(discount)
+        else:
+            raise ValueError("Invalid method %r" % method)
+        self.q_values = self.mdp.action_values(self.values, discount)
+        # V*(s) - Q*(s, a), how much taking a in s loses, inf where not allowed
+        self.action_gaps = self.values[:, np.newaxis] - self.q_values
+
+    def value_error(self, agent):
+        """Largest difference between the estimated and the optimal value of a state."""
+        return float(np.abs(agent.get_state_values() - self.values).max())
+
+    def regret(self, states, actions):
+        """Value lost by the actions of an episode against the optimal ones, summed over its steps."""
+        return float(self.action_gaps[states, actions].sum())
+
+    def suboptimal_states(self, agent):
+        """States where the greedy action of @agent is worse than the optimal one."""
+        states = np.arange(self.mdp.n_states)
+        gaps = self.action_gaps[states, agent.greedy_policy()]
+        return np.flatnonzero(gaps > PLANNING_TOLERANCE)
+
+
+def make_controller():
+    """Controller of train() decaying epsilon and step_size, stopping once values and rewards settle."""
+    return TrainingController(
+        epsilon=Schedule(EPSILON, 0.05, 200),
+        step_size=Schedule(0.2, 0.01, 300, "exponential"),
+        window=50,
+        value_tolerance=0.05,
+        score_tolerance=1.5,
+        patience=2,
+    )
 
-            agent.print_policy()
 
+def train(
+    epochs,
+    print_every_n=PRINT_EVERY_N,
+    profile=False,
+    profile_path=None,
+    plan_every=0,
+    background_planning=False,
+    flyweight=False,
+    mdp=None,
+    baseline=False,
+    stop_when_optimal=False,
+    controller=None,
+    checkpoint_every=0,
+    checkpoint_path="checkpoint_can_collector.bin",
+    resume=False,
+    experience_path=None,
+):
+    """Train robot agent using temporal difference learning.
+
+    With profile, phase timings are collected and printed with each report
+    and at the end, and saved as JSON to profile_path if given.
+
+    With plan_every, value iteration over the learned model runs after every
+    plan_every episodes; with background_planning, it runs continuously in a
+    background thread instead, holding the agent's lock for each run, so the
+    episodes wait for it rather than losing their updates.
+
+    With flyweight, episodes are played by a FlyweightCanCollectionJudger.
+    With mdp, a SparseMDP such as make_robot_mdp(), an MDPRobotAgent is
+    trained on it.
+
+    With baseline, the agent is measured against the OptimalBaseline of its
+    model: every report adds the largest error of the state values, the mean
+    regret of the episodes since the last report and the number of states
+    whose greedy action is not optimal. With stop_when_optimal, training also
+    stops once the greedy policy has been optimal and the value error under
+    OPTIMAL_VALUE_TOLERANCE for OPTIMAL_WINDOW episodes in a row; with a
+    constant step_size the values keep a noise of about 0.18, so this needs
+    plan_every or a controller decaying step_size.
+
+    With controller, a training.TrainingController, epsilon and step_size
+    follow its schedules and training stops once the state values and the
+    average episode reward converge; epochs is then the most episodes.
+
+    With checkpoint_every, the agent's values and model, the reward history
+    and the random stream are checkpointed to checkpoint_path every
+    checkpoint_every episodes by a background thread. With resume, training
+    continues after the episode of the checkpoint at checkpoint_path.
+
+    With experience_path, every transition is appended to the experience log
+    there, for RobotAgent.rebuild_model and replay. A new run starts the log
+    afresh; a checkpoint records the length of the log, and resuming cuts the
+    log back to it.
+    """
+    if profile:
+        PROFILER.reset()
+        PROFILER.enable()
+    if mdp is not None:
+        agent = MDPRobotAgent(mdp, epsilon=EPSILON)
+    else:
+        agent = RobotAgent(epsilon=EPSILON)
+    if flyweight:
+        judger = FlyweightCanCollectionJudger(agent)
+    else:
+        judger = CanCollectionJudger(agent)
+    if background_planning:
+        agent.start_planning()
+    if baseline or stop_when_optimal:
+        optimal = OptimalBaseline(mdp, agent.discount)
+    else:
+        optimal = None
+
+    episode_total_reward_history = []
+    episode_regret_history = []
+    # episodes in a row after which the agent was optimal, for stop_when_optimal
+    optimal_streak = 0
+    if controller is not None:
+        controller.reset()
+    start = 1
+    snapshot = load_checkpoint(checkpoint_path) if resume else None
+    if snapshot is not None:
+        agent.restore(snapshot["agent"])
+        agent.rng.set_state(snapshot["rng"])
+        episode_total_reward_history = snapshot["rewards"]
+        episode_regret_history = snapshot["regrets"]
+        optimal_streak = snapshot.get("optimal_streak", 0)
+        if controller is not None and snapshot["controller"] is not None:
+            controller.set_state(snapshot["controller"])
+        start = snapshot["epoch"] + 1
+        print(f"Resuming after episode {snapshot['epoch']}")
+    checkpointer = None
+    if checkpoint_every:
+        checkpointer = Checkpointer(checkpoint_path, checkpoint_every)
+    experience = None
+    if experience_path is not None:
+        experience = ExperienceLog(experience_path)
+        if snapshot is not None and snapshot.get("experience") is not None:
+            experience.truncate(snapshot["experience"])
+        else:
+            # a new run, the transitions of any earlier one would skew rebuild_model
+            experience.truncate(0)
+
+    try:
+        for i in range(start, epochs + 1):
+            if controller is not None:
+                controller.apply(i, agent)
+            episode_total_reward, episode_individual_reward_history = (
+                judger.play_episode()
+            )
+            episode_total_reward_history.append(episode_total_reward)
+            if experience is not None:
+                experience.append(*judger.transitions())
+
+            if flyweight:
+                judger.backup()
+            else:
+                agent.backup(episode_individual_reward_history)
+            if plan_every and i % plan_every == 0:
+                agent.plan()
+            if optimal is not None:
+                episode_regret_history.append(optimal.regret(*judger.trajectory()))
+                if stop_when_optimal:
+                    if (
+                        not len(optimal.suboptimal_states(agent))
+                        and optimal.value_error(agent) < OPTIMAL_VALUE_TOLERANCE
+                    ):
+                        optimal_streak += 1
+                    else:
+                        optimal_streak = 0
+                    if optimal_streak >= OPTIMAL_WINDOW:
+                        print(
+                            f"\nEpoch {i}: greedy policy and values optimal for {optimal_streak} episodes, stopping"
+                        )
+                        break
+            if controller is not None and controller.update(
+                i, episode_total_reward, agent.get_state_values
+            ):
+                print(f"\nEpoch {i}: converged, {controller.summary()}")
+                break
+
+            if i % print_every_n == 0:
+                avg_reward = (
+                    sum(episode_total_reward_history[-print_every_n:]) / print_every_n
+                )
+                print(f"\nEpoch {i}: Average reward = {avg_reward:.2f}")
+                if mdp is None:
+                    print(
+                        f"State Values: HIGH={agent.estimations.get(hash(HIGH_BATTERY), 0):.3f}, LOW={agent.estimations.get(hash(LOW_BATTERY), 0):.3f}, DEAD={agent.estimations.get(hash(DEAD_BATTERY), 0):.3f}"
+                    )
+                if optimal is not None:
+                    avg_regret = (
+                        sum(episode_regret_history[-print_every_n:]) / print_every_n
+                    )
+                    print(
+                        f"Value error = {optimal.value_error(agent):.3f}, average regret = {avg_regret:.3f}, suboptimal states = {len(optimal.suboptimal_states(agent))}"
+                    )
+
+                agent.print_policy()
+                if profile:
+                    PROFILER.report(profile_path)
+            if checkpointer is not None and checkpointer.due(i):
+                if experience is not None:
+                    # the log holds every transition of the checkpoint before it is written
+                    experience.flush()
+                checkpointer.save(
+                    i,
+                    {
+                        "agent": agent.snapshot(),
+                        "rng": agent.rng.get_state(),
+                        "rewards": list(episode_total_reward_history),
+                        "regrets": list(episode_regret_history),
+                        "optimal_streak": optimal_streak,
+                        "controller": (
+                            None if controller is None else controller.get_state()
+                        ),
+                        "experience": None if experience is None else len(experience),
+                    },
+                )
+    finally:
+        # also writes the last checkpoint when training is interrupted
+        if checkpointer is not None:
+            checkpointer.close()
+        if experience is not None:
+            experience.close()
+
+    agent.stop_planning()
     agent.save_policy()
+    if profile:
+        PROFILER.report(profile_path)
+        PROFILER.disable()
 
     print(
-        f"Training completed! Final average reward: {sum(episode_total_reward_history[-100:]) / 100:.2f}"
+        f"Training completed! Final average reward: {sum(episode_total_reward_history[-100:]) / max(len(episode_total_reward_history[-100:]), 1):.2f}"
     )
 
 
+def train_batched(epochs, robots=1024, print_every_n=PRINT_EVERY_N):
+    """Train one robot agent on the episodes of many robots played at once.
+
+    Every epoch plays an episode of each of the robots with a
+    BatchCanCollectionJudger, so epochs * robots episodes are played in all.
+    """
+    agent = RobotAgent(epsilon=EPSILON)
+    judger = BatchCanCollectionJudger(agent, robots)
+    average_rewards = []
+
+    for i in range(1, epochs + 1):
+        average_rewards.append(judger.play_episode().mean())
+        judger.backup()
+
+        if i % print_every_n == 0:
+            avg_reward = sum(average_rewards[-print_every_n:]) / print_every_n
+            print(f"\nEpoch {i}: Average reward = {avg_reward:.2f}")
+            agent.print_policy()
+
+    agent.save_policy()
+    print(f"Training completed! Final average reward: {average_rewards[-1]:.2f}")
+
+
 if __name__ == "__main__":
-    train(1000)
+    train(1000, controller=make_controller())
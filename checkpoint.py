@@ -0,0 +1,87 @@
+# Periodic checkpoints of the train() loops of tic_tac_toe.py and
+# can_collector.py. The training thread only copies its state; a background
+# thread pickles the copy and renames it over the checkpoint file, so training
+# does not wait on the disk and a crash never leaves a partial checkpoint.
+
+import os
+import pickle
+import threading
+
+
+class Checkpointer:
+    """Writes the latest snapshot handed to it to one file, from a background thread."""
+
+    def __init__(self, path, every):
+        """Checkpoint to @path every @every epochs."""
+        self.path = path
+        self.every = every
+        # the snapshot waiting to be written, a newer one replaces it
+        self.pending = None
+        self.condition = threading.Condition()
+        self.closed = False
+        self.error = None
+        self.saved_epoch = None
+        self.writer = threading.Thread(
+            target=self.run, name="Checkpointer", daemon=True
+        )
+        self.writer.start()
+
+    def due(self, epoch):
+        """Whether @epoch is one to checkpoint."""
+        return self.every > 0 and epoch % self.every == 0
+
+    def save(self, epoch, snapshot):
+        """Queue @snapshot, a dict the caller no longer changes, as the checkpoint of @epoch."""
+        if self.error is not None:
+            raise self.error
+        with self.condition:
+            self.pending = dict(snapshot, epoch=epoch)
+            self.condition.notify()
+
+    def run(self):
+        """Write the pending snapshots until closed."""
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                snapshot, self.pending = self.pending, None
+            try:
+                write_checkpoint(self.path, snapshot)
+                self.saved_epoch = snapshot["epoch"]
+            except Exception as error:
+                # raised in the training thread by the next save() or close()
+                self.error = error
+
+    def close(self):
+        """Write the last pending snapshot and stop the writer."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.writer.join()
+        if self.error is not None:
+            raise self.error
+
+
+def write_checkpoint(path, snapshot):
+    """Pickle @snapshot to @path, renamed into place so readers never see a partial file."""
+    tmp_path = "%s.tmp%d" % (path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_checkpoint(path):
+    """The snapshot saved at @path, None if there is no checkpoint yet."""
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,125 @@
+# Append-only log of the transitions of a RobotAgent. Each transition is a
+# fixed size binary record after a small header, appended a chunk at a time,
+# so the log grows without ever being rewritten, and readers memory-map it to
+# rebuild a model or replay experience a chunk at a time.
+
+import os
+import struct
+
+import numpy as np
+
+EXPERIENCE_MAGIC = b"RLEXPLOG"
+EXPERIENCE_VERSION = 1
+# magic, version, record size
+EXPERIENCE_HEADER = struct.Struct("<8sHH")
+# records start on a 64 byte boundary
+EXPERIENCE_OFFSET = 64
+# one transition, 14 bytes
+TRANSITION = np.dtype(
+    [
+        ("state", "<i4"),
+        ("action", "i1"),
+        ("greedy", "i1"),
+        ("reward", "<f4"),
+        ("next_state", "<i4"),
+    ]
+)
+CHUNK_SIZE = 8192
+
+
+class ExperienceLog:
+    """Writer of an experience log, buffering transitions and appending them a chunk at a time."""
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        """Append to the log at @path, created if missing, writing every @chunk_size transitions."""
+        self.path = path
+        self.chunk_size = chunk_size
+        self.buffer = np.zeros(chunk_size, TRANSITION)
+        self.buffered = 0
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, "wb") as f:
+                header = EXPERIENCE_HEADER.pack(
+                    EXPERIENCE_MAGIC, EXPERIENCE_VERSION, TRANSITION.itemsize
+                )
+                f.write(header.ljust(EXPERIENCE_OFFSET, b"\0"))
+        else:
+            check_header(path)
+        # a record cut short by a crash is dropped, the next chunk starts after the last whole one
+        self.written = count_records(path)
+        self.truncate(self.written)
+
+    def __len__(self):
+        """Number of transitions logged, written or buffered."""
+        return self.written + self.buffered
+
+    def append(self, states, actions, greedy, rewards, next_states):
+        """Log the transitions of arrays of states, actions, greediness, rewards and next states."""
+        count = len(states)
+        start = 0
+        while start < count:
+            size = min(self.chunk_size - self.buffered, count - start)
+            chunk = self.buffer[self.buffered : self.buffered + size]
+            chunk["state"] = states[start : start + size]
+            chunk["action"] = actions[start : start + size]
+            chunk["greedy"] = greedy[start : start + size]
+            chunk["reward"] = rewards[start : start + size]
+            chunk["next_state"] = next_states[start : start + size]
+            self.buffered += size
+            start += size
+            if self.buffered == self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        """Append the buffered transitions to the file."""
+        if not self.buffered:
+            return
+        with open(self.path, "ab") as f:
+            f.write(self.buffer[: self.buffered].tobytes())
+        self.written += self.buffered
+        self.buffered = 0
+
+    def truncate(self, records):
+        """Keep only the first @records transitions, e.g. those of the checkpoint being resumed."""
+        self.flush()
+        if records > self.written:
+            raise ValueError("The log only has %d transitions" % self.written)
+        os.truncate(self.path, EXPERIENCE_OFFSET + records * TRANSITION.itemsize)
+        self.written = records
+
+    def close(self):
+        """Write what is still buffered."""
+        self.flush()
+
+
+def check_header(path):
+    """Raise ValueError unless @path is an experience log this version can read."""
+    with open(path, "rb") as f:
+        data = f.read(EXPERIENCE_HEADER.size)
+    if len(data) < EXPERIENCE_HEADER.size or data[:8] != EXPERIENCE_MAGIC:
+        raise ValueError("%s is not an experience log" % path)
+    _, version, record_size = EXPERIENCE_HEADER.unpack(data)
+    if version != EXPERIENCE_VERSION or record_size != TRANSITION.itemsize:
+        raise ValueError("Unsupported experience log version %d" % version)
+
+
+def count_records(path):
+    """Number of whole transitions in the log at @path."""
+    return max(os.path.getsize(path) - EXPERIENCE_OFFSET, 0) // TRANSITION.itemsize
+
+
+def read_log(path):
+    """Read-only memory map of the transitions of the log at @path, a structured array."""
+    check_header(path)
+    count = count_records(path)
+    if count == 0:
+        return np.zeros(0, TRANSITION)
+    return np.memmap(
+        path, dtype=TRANSITION, mode="r", offset=EXPERIENCE_OFFSET, shape=(count,)
+    )
+
+
+def chunks(path, chunk_size=CHUNK_SIZE):
+    """The transitions of the log at @path, @chunk_size at a time, as views of the memory map."""
+    transitions = read_log(path)
+    for start in range(0, len(transitions), chunk_size):
+        yield transitions[start : start + chunk_size]
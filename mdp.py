@@ -0,0 +1,166 @@
+# Finite MDPs defined by data instead of code, for environments too large to
+# branch on by hand. The outcomes of every (state, action) pair are stored in
+# CSR form, so memory, sampling and sweeps scale with the number of nonzero
+# transitions rather than with states * actions * states.
+
+import bisect
+
+import numpy as np
+
+
+class SparseMDP:
+    """MDP whose outcomes are the rows of a CSR table, one row per (state, action)."""
+
+    def __init__(
+        self, n_states, n_actions, indptr, next_states, rewards, probs, initial_state=0
+    ):
+        """Create an MDP from its CSR arrays.
+
+        Row state * n_actions + action holds the entries indptr[row] to
+        indptr[row + 1], each a next state, a reward and the probability of
+        that outcome. An empty row is an action that is not allowed in the
+        state; every other row must sum to 1.
+        """
+        self.n_states = n_states
+        self.n_actions = n_actions
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.next_states = np.asarray(next_states, dtype=np.intp)
+        self.rewards = np.asarray(rewards, dtype=np.float64)
+        self.probs = np.asarray(probs, dtype=np.float64)
+        self.initial_state = initial_state
+        if len(self.indptr) != n_states * n_actions + 1:
+            raise ValueError("indptr needs n_states * n_actions + 1 entries")
+        sizes = np.diff(self.indptr)
+        # row of every entry
+        self.entry_rows = np.repeat(np.arange(n_states * n_actions), sizes)
+        row_sums = np.bincount(
+            self.entry_rows, self.probs, minlength=n_states * n_actions
+        )
+        if not np.allclose(row_sums[sizes > 0], 1):
+            raise ValueError("The outcome probabilities of an action must sum to 1")
+        self.valid = (sizes > 0).reshape(n_states, n_actions)
+        self.valid_action_lists = [np.flatnonzero(row).tolist() for row in self.valid]
+        self.entry_actions = self.entry_rows % n_actions
+
+        # sampling keys: row + cumulative probability within the row, so one
+        # bisection over all entries finds the outcome of a draw in any row
+        cumulative = np.cumsum(self.probs)
+        row_starts = np.concatenate(([0.0], cumulative))[self.indptr[:-1]]
+        keys = self.entry_rows + cumulative - row_starts[self.entry_rows]
+        # the last entry of a row ends exactly at the next row
+        keys[self.indptr[1:][sizes > 0] - 1] = (
+            self.entry_rows[self.indptr[1:][sizes > 0] - 1] + 1
+        )
+        self.keys = keys
+        self.keys_list = keys.tolist()
+        self.next_states_list = self.next_states.tolist()
+        self.rewards_list = self.rewards.tolist()
+
+    @classmethod
+    def from_outcomes(cls, n_states, n_actions, outcomes, initial_state=0):
+        """Build an MDP from {(state, action): [(next_state, reward, prob), ...]}."""
+        indptr = [0]
+        next_states = []
+        rewards = []
+        probs = []
+        for state in range(n_states):
+            for action in range(n_actions):
+                merged = {}
+                for next_state, reward, prob in outcomes.get((state, action), ()):
+                    if prob > 0:
+                        key = (next_state, reward)
+                        merged[key] = merged.get(key, 0.0) + prob
+                for (next_state, reward), prob in sorted(merged.items()):
+                    next_states.append(next_state)
+                    rewards.append(reward)
+                    probs.append(prob)
+                indptr.append(len(probs))
+        return cls(
+            n_states, n_actions, indptr, next_states, rewards, probs, initial_state
+        )
+
+    @property
+    def nnz(self):
+        """Number of stored outcomes."""
+        return len(self.probs)
+
+    def sample(self, state, action, u):
+        """Index of the outcome of @action in @state chosen by the uniform draw @u."""
+        return bisect.bisect_right(self.keys_list, state * self.n_actions + action + u)
+
+    def sample_batch(self, states, actions, u):
+        """Indices of the outcomes chosen by arrays of states, actions and draws."""
+        return np.searchsorted(
+            self.keys, states * self.n_actions + actions + u, "right"
+        )
+
+    def action_values(self, values, discount, probs=None):
+        """(states, actions) expected values of the actions under @values, -inf where not allowed."""
+        if probs is None:
+            probs = self.probs
+        q_values = np.bincount(
+            self.entry_rows,
+            probs * (self.rewards + discount * values[self.next_states]),
+            minlength=self.n_states * self.n_actions,
+        ).reshape(self.n_states, self.n_actions)
+        q_values[~self.valid] = -np.inf
+        return q_values
+
+    def solve(self, discount, tolerance=1e-9, max_sweeps=10000):
+        """Optimal values and greedy policy by value iteration."""
+        values = np.zeros(self.n_states)
+        for _ in range(max_sweeps):
+            q_values = self.action_values(values, discount)
+            new_values = q_values.max(axis=1)
+            change = np.abs(new_values - values).max()
+            values = new_values
+            if change < tolerance:
+                break
+        return values, self.action_values(values, discount).argmax(axis=1)
+
+    def policy_values(
+        self, policy, discount, values=None, tolerance=1e-9, max_sweeps=10000
+    ):
+        """Values of the deterministic @policy, one action per state, by iterative evaluation from @values."""
+        rows = np.arange(self.n_states) * self.n_actions + policy
+        if not self.valid.reshape(-1)[rows].all():
+            raise ValueError("The policy takes an action that is not allowed")
+        # only the entries of the rows the policy follows, so a sweep is O(nnz)
+        followed = self.entry_actions == policy[self.entry_rows // self.n_actions]
+        states = self.entry_rows[followed] // self.n_actions
+        next_states = self.next_states[followed]
+        probs = self.probs[followed]
+        rewards = np.bincount(
+            states, probs * self.rewards[followed], minlength=self.n_states
+        )
+        values = np.zeros(self.n_states) if values is None else values
+        for _ in range(max_sweeps):
+            # V = R + γ P V
+            new_values = rewards + discount * np.bincount(
+                states, probs * values[next_states], minlength=self.n_states
+            )
+            change = np.abs(new_values - values).max()
+            values = new_values
+            if change < tolerance:
+                break
+        return values
+
+    def policy_iteration(self, discount, max_iterations=1000):
+        """Optimal values and greedy policy by policy iteration."""
+        # start from the first allowed action of every state
+        policy = self.valid.argmax(axis=1)
+        values = None
+        for _ in range(max_iterations):
+            # each evaluation starts from the values of the previous policy
+            values = self.policy_values(policy, discount, values)
+            q_values = self.action_values(values, discount)
+            # only switch to strictly better actions, so that ties cannot cycle
+            improved = q_values.argmax(axis=1)
+            better = (
+                q_values[np.arange(self.n_states), improved]
+                > q_values[np.arange(self.n_states), policy] + 1e-12
+            )
+            if not better.any():
+                break
+            policy = np.where(better, improved, policy)
+        return values, policy
@@ -0,0 +1,89 @@
+# Opt-in counters and phase timers for the hot paths of tic_tac_toe.py and
+# can_collector.py. Everything goes through the shared PROFILER, which is
+# disabled unless enabled in code or with the RL_PROFILE environment variable.
+
+import json
+import os
+import time
+from collections import defaultdict
+
+
+class Profiler:
+    """Per-phase call counts and cumulative times, collected only when enabled."""
+
+    def __init__(self, enabled=False):
+        """Create an empty profiler, disabled unless @enabled."""
+        # instrumented code checks this flag before taking any timestamp,
+        # so a disabled profiler costs one attribute lookup per check
+        self.enabled = enabled
+        self.counts = defaultdict(int)
+        self.times = defaultdict(float)
+        self.started = time.perf_counter()
+
+    def enable(self):
+        """Start collecting."""
+        self.enabled = True
+
+    def disable(self):
+        """Stop collecting, keeping what was collected."""
+        self.enabled = False
+
+    def reset(self):
+        """Forget everything collected so far."""
+        self.counts.clear()
+        self.times.clear()
+        self.started = time.perf_counter()
+
+    def add(self, phase, elapsed, count=1):
+        """Record @count calls of @phase that took @elapsed seconds in total."""
+        self.counts[phase] += count
+        self.times[phase] += elapsed
+
+    def count(self, phase, count=1):
+        """Record @count events of @phase without timing them."""
+        self.counts[phase] += count
+
+    def as_dict(self):
+        """Collected counters and timings, slowest phase first."""
+        phases = sorted(self.counts, key=lambda phase: -self.times[phase])
+        return {
+            "wall_time": time.perf_counter() - self.started,
+            "phases": {
+                phase: {
+                    "count": self.counts[phase],
+                    "total": self.times[phase],
+                    "mean": self.times[phase] / self.counts[phase],
+                }
+                for phase in phases
+            },
+        }
+
+    def summary(self):
+        """Collected counters and timings as a text table."""
+        data = self.as_dict()
+        lines = [
+            f"{'phase':32} | {'count':>10} | {'total s':>9} | {'mean us':>9} | {'share':>6}",
+            "-" * 33 + "|" + "-" * 12 + "|" + "-" * 11 + "|" + "-" * 11 + "|" + "-" * 7,
+        ]
+        for phase, stats in data["phases"].items():
+            share = stats["total"] / data["wall_time"] if data["wall_time"] else 0
+            lines.append(
+                f"{phase:32} | {stats['count']:10d} | {stats['total']:9.3f} |"
+                f" {stats['mean'] * 1e6:9.2f} | {share:6.1%}"
+            )
+        return "\n".join(lines)
+
+    def save(self, path):
+        """Write the collected counters and timings to @path as JSON."""
+        with open(path, "w") as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def report(self, path=None):
+        """Print the summary table, and save it as JSON to @path if given."""
+        print(self.summary())
+        if path is not None:
+            self.save(path)
+
+
+# shared by both modules, set RL_PROFILE=1 to enable it from the start
+PROFILER = Profiler(enabled=os.environ.get("RL_PROFILE", "") not in ("", "0"))
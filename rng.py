@@ -0,0 +1,93 @@
+# Pooled random numbers for the per-step hot paths of tic_tac_toe.py and
+# can_collector.py. Every scalar call into np.random costs about a microsecond,
+# so the players and states draw from a RandomPool that fills blocks at a time.
+
+import numpy as np
+
+BLOCK_SIZE = 4096
+
+
+class RandomPool:
+    """Uniform random numbers drawn from a Generator in blocks and handed out one at a time."""
+
+    def __init__(self, seed=None, block_size=BLOCK_SIZE):
+        """Create a pool over a new Generator seeded with @seed (an int, a SeedSequence or None)."""
+        self.block_size = block_size
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        """Restart the pool from a new Generator seeded with @seed."""
+        # the Generator is created on first use, numpy.random alone takes
+        # longer to import than the modules using the shared pool
+        self.seed_value = seed
+        self.seed_sequence_cache = None
+        self.generator_cache = None
+        self.block = []
+
+    @property
+    def seed_sequence(self):
+        """SeedSequence of the Generator."""
+        if self.seed_sequence_cache is None:
+            self.seed_sequence_cache = (
+                self.seed_value
+                if isinstance(self.seed_value, np.random.SeedSequence)
+                else np.random.SeedSequence(self.seed_value)
+            )
+        return self.seed_sequence_cache
+
+    @property
+    def generator(self):
+        """Generator the blocks are drawn from."""
+        if self.generator_cache is None:
+            self.generator_cache = np.random.default_rng(self.seed_sequence)
+        return self.generator_cache
+
+    def random(self):
+        """Uniform float in [0, 1)."""
+        try:
+            return self.block.pop()
+        except IndexError:
+            # reversed so that pop() hands the numbers out in the order they were drawn
+            self.block = self.generator.random(self.block_size)[::-1].tolist()
+            return self.block.pop()
+
+    def integers(self, high):
+        """Uniform int in [0, @high)."""
+        return int(self.random() * high)
+
+    def choice(self, items):
+        """Uniformly chosen element of the sequence @items."""
+        return items[int(self.random() * len(items))]
+
+    def spawn(self, n):
+        """@n independent pools, e.g. one per worker process."""
+        return [
+            RandomPool(seed_sequence, self.block_size)
+            for seed_sequence in self.seed_sequence.spawn(n)
+        ]
+
+    def get_state(self):
+        """Everything needed to resume the stream with set_state()."""
+        return {
+            "bit_generator": self.generator.bit_generator.state,
+            "block": list(self.block),
+        }
+
+    def set_state(self, state):
+        """Resume the stream saved by get_state()."""
+        self.generator.bit_generator.state = state["bit_generator"]
+        self.block = list(state["block"])
+
+
+# shared by both modules unless a player, agent or state is given its own pool
+RNG = RandomPool()
+
+
+def seed(seed=None):
+    """Reseed the shared pool."""
+    RNG.seed(seed)
+
+
+def worker_pool(seed, worker):
+    """Independent pool of @worker, reproducible from @seed whatever the number of workers."""
+    return RandomPool(np.random.SeedSequence(seed, spawn_key=(worker,)))
@@ -0,0 +1,244 @@
+# Hyperparameter sweeps of tic_tac_toe.Player and can_collector.RobotAgent.
+#
+#   python sweep.py tic_tac_toe --step-size 0.05 0.1 0.2 --epsilon 0.01 0.1
+#   python sweep.py can_collector --epsilon 0.1 0.3 --discount 0.9 0.99 --epochs 200
+#
+# Every combination of the grid and the seeds is trained in a process pool.
+# Each configuration is written to the results file as one JSON line holding
+# its learning curve and final score, as soon as it finishes. Running the same
+# command again skips the configurations already in the file, so an
+# interrupted sweep resumes where it stopped.
+
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import os
+import sys
+
+import numpy as np
+
+import can_collector
+import tic_tac_toe
+from rng import RandomPool
+
+MODULES = ("tic_tac_toe", "can_collector")
+
+
+def configurations(grid):
+    """Every combination of the values of @grid, a dict of lists."""
+    names = sorted(grid)
+    return [
+        dict(zip(names, values))
+        for values in itertools.product(*(grid[name] for name in names))
+    ]
+
+
+def config_key(config, epochs, eval_every):
+    """Identity of a configuration trained @epochs epochs, evaluated every @eval_every, in the results file."""
+    return json.dumps(
+        dict(config, epochs=epochs, eval_every=eval_every), sort_keys=True
+    )
+
+
+def read_results(path):
+    """The complete results lines of the file at @path."""
+    results = []
+    if not os.path.exists(path):
+        return results
+    with open(path) as f:
+        for line in f:
+            try:
+                results.append(json.loads(line))
+            except ValueError:
+                # a line cut short by an interrupted sweep, that configuration runs again
+                continue
+    return results
+
+
+def result_key(result):
+    """config_key of a results line, lines written without eval_every never match."""
+    return config_key(result["config"], result["epochs"], result.get("eval_every"))
+
+
+def completed(path):
+    """Keys of the configurations already in the results file at @path."""
+    return {result_key(result) for result in read_results(path)}
+
+
+def ends_with_newline(path):
+    """Whether the last line of the file at @path is complete."""
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def run_tic_tac_toe(config, epochs, eval_every):
+    """Train two players with @config, scored by evaluate_policy() every @eval_every games."""
+    rng = RandomPool(config["seed"])
+    player1 = tic_tac_toe.Player(
+        config["step_size"], config["epsilon"], dense=True, rng=rng
+    )
+    player2 = tic_tac_toe.Player(
+        config["step_size"], config["epsilon"], dense=True, rng=rng
+    )
+    judger = tic_tac_toe.Judger(player1, player2)
+    curve = []
+    for i in range(1, epochs + 1):
+        judger.play()
+        player1.backup()
+        player2.backup()
+        judger.reset()
+        if i % eval_every == 0 or i == epochs:
+            first = tic_tac_toe.evaluate_policy(player1)
+            second = tic_tac_toe.evaluate_policy(player2)
+            curve.append(
+                {
+                    "epoch": i,
+                    "player1_optimal_move_rate": first["optimal_move_rate"],
+                    "player2_optimal_move_rate": second["optimal_move_rate"],
+                    "player1_worst_case": first["worst_case_outcome"],
+                    "player2_worst_case": second["worst_case_outcome"],
+                }
+            )
+    final = curve[-1]
+    score = (
+        final["player1_optimal_move_rate"] + final["player2_optimal_move_rate"]
+    ) / 2
+    return curve, score
+
+
+def run_can_collector(config, epochs, eval_every):
+    """Train an agent with @config, averaging its reward over every @eval_every episodes."""
+    agent = can_collector.RobotAgent(
+        config["step_size"],
+        config["epsilon"],
+        config["discount"],
+        rng=RandomPool(config["seed"]),
+    )
+    judger = can_collector.CanCollectionJudger(agent)
+    rewards = []
+    curve = []
+    for i in range(1, epochs + 1):
+        total_reward, reward_history = judger.play_episode()
+        rewards.append(total_reward)
+        agent.backup(reward_history)
+        if i % eval_every == 0 or i == epochs:
+            curve.append(
+                {
+                    "epoch": i,
+                    "average_reward": float(np.mean(rewards[-eval_every:])),
+                    "values": [
+                        agent.estimations.get(hash(level), 0)
+                        for level in (
+                            can_collector.HIGH_BATTERY,
+                            can_collector.LOW_BATTERY,
+                            can_collector.DEAD_BATTERY,
+                        )
+                    ],
+                }
+            )
+    return curve, float(np.mean(rewards[-100:]))
+
+
+RUNNERS = {"tic_tac_toe": run_tic_tac_toe, "can_collector": run_can_collector}
+
+
+def init_worker(module):
+    """Load the read-only data of @module once per worker."""
+    if module == "tic_tac_toe":
+        # memory-maps the cache written by the parent, the pages are shared between workers
+        tic_tac_toe.get_state_table()
+        tic_tac_toe.get_minimax_values()
+
+
+def run_config(task):
+    """Run one configuration in a worker, returning its results line."""
+    module, config, epochs, eval_every = task
+    curve, score = RUNNERS[module](config, epochs, eval_every)
+    return {
+        "module": module,
+        "config": config,
+        "epochs": epochs,
+        "eval_every": eval_every,
+        "score": score,
+        "curve": curve,
+    }
+
+
+def sweep(module, grid, epochs, output, workers=None, eval_every=None):
+    """Run the configurations of @grid not yet in @output, appending each as it finishes."""
+    if module not in RUNNERS:
+        raise ValueError("Invalid module %r" % module)
+    if eval_every is None:
+        eval_every = max(1, epochs // 20)
+    if module == "tic_tac_toe":
+        # build and save the caches before the workers start, so none of them rebuilds them
+        tic_tac_toe.get_state_table()
+        tic_tac_toe.get_minimax_values()
+    done = completed(output)
+    tasks = [
+        (module, config, epochs, eval_every)
+        for config in configurations(grid)
+        if config_key(config, epochs, eval_every) not in done
+    ]
+    print(f"{len(done)} configurations done, {len(tasks)} to run")
+    if not tasks:
+        return
+    with (
+        mp.Pool(workers, initializer=init_worker, initargs=(module,)) as pool,
+        open(output, "a") as f,
+    ):
+        if f.tell() and not ends_with_newline(output):
+            # terminate the line cut short by an interrupted sweep
+            f.write("\n")
+        for result in pool.imap_unordered(run_config, tasks):
+            f.write(json.dumps(result) + "\n")
+            f.flush()
+            print(f"score {result['score']:.4f} {result_key(result)}")
+
+
+def best(output, n=5, epochs=None, eval_every=None):
+    """The @n best configurations in the results file at @output, of @epochs and @eval_every if given."""
+    results = [
+        result
+        for result in read_results(output)
+        if epochs in (None, result["epochs"])
+        and eval_every in (None, result.get("eval_every"))
+    ]
+    return sorted(results, key=lambda result: -result["score"])[:n]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sweep step_size and epsilon (and discount) over a process pool."
+    )
+    parser.add_argument("module", choices=MODULES)
+    parser.add_argument("--step-size", type=float, nargs="+", default=[0.1])
+    parser.add_argument("--epsilon", type=float, nargs="+")
+    parser.add_argument("--discount", type=float, nargs="+")
+    parser.add_argument("--seed", type=int, nargs="+", default=[0])
+    parser.add_argument("--epochs", type=int)
+    parser.add_argument("--eval-every", type=int)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    grid = {"step_size": args.step_size, "seed": args.seed}
+    if args.module == "tic_tac_toe":
+        grid["epsilon"] = args.epsilon or [0.01]
+        epochs = args.epochs or 10000
+    else:
+        grid["epsilon"] = args.epsilon or [can_collector.EPSILON]
+        grid["discount"] = args.discount or [can_collector.DISCOUNT]
+        epochs = args.epochs or 200
+    output = args.output or f"sweep_{args.module}.jsonl"
+    eval_every = args.eval_every or max(1, epochs // 20)
+    sweep(args.module, grid, epochs, output, args.workers, eval_every)
+    for result in best(output, epochs=epochs, eval_every=eval_every):
+        print(f"best {result['score']:.4f} {result_key(result)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
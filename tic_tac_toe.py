@@ -8,14 +8,32 @@
 # declaration at the top                                              #
 #######################################################################
 
+import os
 import pickle
+import shutil
+import struct
+from functools import cached_property
+from time import perf_counter
 
 import numpy as np
 
+from checkpoint import Checkpointer, load_checkpoint
+from profiling import PROFILER
+from rng import RNG, worker_pool
+from training import Schedule, TrainingController
+
 BOARD_ROWS = 3
 BOARD_COLS = 3
 BOARD_SIZE = BOARD_ROWS * BOARD_COLS
 
+# bump when the layout of the cached state table changes,
+# binary policy files store values in the order of this table
+STATE_CACHE_VERSION = 1
+STATE_CACHE_DIR = os.environ.get(
+    "TIC_TAC_TOE_CACHE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"),
+)
+
 
 class State:
     def __init__(self):
@@ -27,6 +45,8 @@ class State:
         self.winner = None
         self.hash_val = None
         self.end = None
+        # dense id of this board in the state table, if known
+        self.state_id = None
 
     # compute the hash value for one state, it's unique
     def hash(self):
@@ -86,6 +106,10 @@ class State:
         new_state.data[i, j] = symbol
         return new_state
 
+    # whether position (i, j) is empty
+    def is_empty(self, i, j):
+        return self.data[i, j] == 0
+
     # print the board
     def print_state(self):
         for i in range(BOARD_ROWS):
@@ -106,7 +130,7 @@ class State:
 def get_all_states_impl(current_state, current_symbol, all_states):
     for i in range(BOARD_ROWS):
         for j in range(BOARD_COLS):
-            if current_state.data[i][j] == 0:
+            if current_state.is_empty(i, j):
                 new_state = current_state.next_state(i, j, current_symbol)
                 new_hash = new_state.hash()
                 if new_hash not in all_states:
@@ -116,25 +140,676 @@ def get_all_states_impl(current_state, current_symbol, all_states):
                         get_all_states_impl(new_state, -current_symbol, all_states)
 
 
-def get_all_states():
+# @state_cls: State or BitboardState
+def get_all_states(state_cls=State):
     current_symbol = 1
-    current_state = State()
+    current_state = state_cls()
     all_states = dict()
     all_states[current_state.hash()] = (current_state, current_state.is_end())
     get_all_states_impl(current_state, current_symbol, all_states)
     return all_states
 
 
-# all possible board configurations
-all_states = get_all_states()
+# flat cell indices of every row, column and diagonal
+def get_lines():
+    cells = np.arange(BOARD_SIZE).reshape(BOARD_ROWS, BOARD_COLS)
+    lines = [cells[i, :] for i in range(BOARD_ROWS)]
+    lines += [cells[:, j] for j in range(BOARD_COLS)]
+    lines.append(np.diag(cells))
+    lines.append(np.diag(np.fliplr(cells)))
+    return np.array(lines)
+
+
+LINES = get_lines()
+# weight of each cell in the base 3 hash, matching State.hash()
+HASH_WEIGHTS = 3 ** np.arange(BOARD_SIZE - 1, -1, -1, dtype=np.int64)
+
+
+# hash values of a batch of flat boards, same values as State.hash()
+def hash_boards(boards):
+    return (boards.astype(np.int64) + 1) @ HASH_WEIGHTS
+
+
+# winner and end flag of a batch of flat boards, same rules as State.is_end()
+def judge_boards(boards):
+    sums = boards[:, LINES].sum(axis=2, dtype=np.int64)
+    winners = np.zeros(len(boards), dtype=np.int8)
+    winners[(sums == -BOARD_ROWS).any(axis=1)] = -1
+    winners[(sums == BOARD_ROWS).any(axis=1)] = 1
+    ends = (winners != 0) | (boards != 0).all(axis=1)
+    return winners, ends
+
+
+# cell permutations of the 8 rotations and reflections of the (square) board,
+# the board transformed by symmetry t is board[SYMMETRIES[t]]
+def get_symmetries():
+    cells = np.arange(BOARD_SIZE).reshape(BOARD_ROWS, BOARD_COLS)
+    symmetries = []
+    for k in range(4):
+        rotated = np.rot90(cells, k)
+        symmetries.append(rotated.ravel())
+        symmetries.append(np.fliplr(rotated).ravel())
+    return np.array(symmetries)
+
+
+SYMMETRIES = get_symmetries()
+
+
+# bit masks of every row, column and diagonal of a bitboard
+WIN_MASKS = [sum(1 << cell for cell in line) for line in LINES.tolist()]
+FULL_MASK = (1 << BOARD_SIZE) - 1
+# hash of the empty board, and the hash weight of every 9 bit set of cells
+EMPTY_HASH = int(HASH_WEIGHTS.sum())
+BITS_HASH = [
+    sum(int(HASH_WEIGHTS[cell]) for cell in range(BOARD_SIZE) if bits >> cell & 1)
+    for bits in range(1 << BOARD_SIZE)
+]
+
+
+# a State storing the chessmen of each player as the bits of an int,
+# with the same hash, winner and printing as State
+class BitboardState:
+    __slots__ = ("first", "second", "hash_val", "winner", "end", "state_id")
+
+    # @first: bit i is set if the player who moves first has a chessman at cell i
+    # @second: bit i is set if the other player has a chessman at cell i
+    def __init__(self, first=0, second=0):
+        self.first = first
+        self.second = second
+        self.winner = None
+        self.hash_val = None
+        self.end = None
+        self.state_id = None
+
+    # the board as the n * n array of State
+    @property
+    def data(self):
+        data = np.zeros(BOARD_SIZE)
+        for cell in range(BOARD_SIZE):
+            if self.first >> cell & 1:
+                data[cell] = 1
+            elif self.second >> cell & 1:
+                data[cell] = -1
+        return data.reshape(BOARD_ROWS, BOARD_COLS)
+
+    # a chessman of the first player adds its weight to the hash of the empty board,
+    # a chessman of the other player subtracts it
+    def hash(self):
+        if self.hash_val is None:
+            self.hash_val = float(
+                EMPTY_HASH + BITS_HASH[self.first] - BITS_HASH[self.second]
+            )
+        return self.hash_val
+
+    def is_end(self):
+        if self.end is not None:
+            return self.end
+        for mask in WIN_MASKS:
+            if self.first & mask == mask:
+                self.winner = 1
+                self.end = True
+                return self.end
+            if self.second & mask == mask:
+                self.winner = -1
+                self.end = True
+                return self.end
+
+        # whether it's a tie
+        if self.first | self.second == FULL_MASK:
+            self.winner = 0
+            self.end = True
+            return self.end
+
+        # game is still going on
+        self.end = False
+        return self.end
+
+    # @symbol: 1 or -1
+    # put chessman symbol in position (i, j)
+    def next_state(self, i, j, symbol):
+        cell = i * BOARD_COLS + j
+        bit = 1 << cell
+        first = self.first & ~bit
+        second = self.second & ~bit
+        if symbol == 1:
+            first |= bit
+        elif symbol == -1:
+            second |= bit
+        new_state = BitboardState(first, second)
+        if self.hash_val is not None and not (self.first | self.second) & bit:
+            new_state.hash_val = self.hash_val + symbol * int(HASH_WEIGHTS[cell])
+        return new_state
+
+    def is_empty(self, i, j):
+        return not (self.first | self.second) >> (i * BOARD_COLS + j) & 1
+
+    def print_state(self):
+        for i in range(BOARD_ROWS):
+            print("-------------")
+            out = "| "
+            for j in range(BOARD_COLS):
+                bit = 1 << (i * BOARD_COLS + j)
+                if self.first & bit:
+                    token = "*"
+                elif self.second & bit:
+                    token = "x"
+                else:
+                    token = "0"
+                out += token + " | "
+            print(out)
+        print("-------------")
+
+
+# a board of any size where @win_length chessmen in a row win,
+# its states are created as they are reached instead of enumerated up front
+class Board:
+    # @seed: seed of the Zobrist keys, saved policies are only valid for the same keys
+    def __init__(self, rows=BOARD_ROWS, cols=BOARD_COLS, win_length=3, seed=0):
+        self.rows = rows
+        self.cols = cols
+        self.size = rows * cols
+        self.win_length = win_length
+        # a random key per (cell, chessman), the hash of a board is the xor of the keys of its chessmen
+        keys = np.random.default_rng(seed).integers(0, 2**63, size=(self.size, 2))
+        self.zobrist = [{1: first, -1: second} for first, second in keys.tolist()]
+        # for each cell and direction, the cells before and after it that can
+        # complete a line through it
+        self.rays = []
+        for cell in range(self.size):
+            i, j = divmod(cell, cols)
+            rays = []
+            for di, dj in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                rays.append([self.ray(i, j, di * sign, dj * sign) for sign in (1, -1)])
+            self.rays.append(rays)
+
+    def ray(self, i, j, di, dj):
+        cells = []
+        for step in range(1, self.win_length):
+            r, c = i + di * step, j + dj * step
+            if not (0 <= r < self.rows and 0 <= c < self.cols):
+                break
+            cells.append(r * self.cols + c)
+        return cells
+
+    # whether putting chessman @symbol at @cell of the flat board @cells wins
+    def is_win(self, cells, cell, symbol):
+        for forward, backward in self.rays[cell]:
+            count = 1
+            for other in forward:
+                if cells[other] != symbol:
+                    break
+                count += 1
+            for other in backward:
+                if cells[other] != symbol:
+                    break
+                count += 1
+            if count >= self.win_length:
+                return True
+        return False
+
+    def initial_state(self):
+        return ZobristState(self, [0] * self.size, 0, 0)
+
+
+# a state of a Board, hashed incrementally with the Zobrist keys of the board
+class ZobristState:
+    __slots__ = ("board", "cells", "hash_val", "count", "winner", "end")
+
+    # @cells: flat board, 1 or -1 for a chessman, 0 for an empty position
+    # @count: the number of chessmen on the board
+    def __init__(self, board, cells, hash_val, count, winner=None, end=False):
+        self.board = board
+        self.cells = cells
+        self.hash_val = hash_val
+        self.count = count
+        self.winner = winner
+        self.end = end
+
+    def hash(self):
+        return self.hash_val
+
+    # only the lines through the new chessman are checked, so the end is known on creation
+    def is_end(self):
+        return self.end
+
+    # @symbol: 1 or -1
+    # put chessman symbol in position (i, j), which must be empty
+    def next_state(self, i, j, symbol):
+        board = self.board
+        cell = i * board.cols + j
+        if self.cells[cell] != 0:
+            raise ValueError("Invalid move (%d, %d)" % (i, j))
+        cells = self.cells.copy()
+        cells[cell] = symbol
+        new_state = ZobristState(
+            board, cells, self.hash_val ^ board.zobrist[cell][symbol], self.count + 1
+        )
+        if board.is_win(cells, cell, symbol):
+            new_state.winner = symbol
+            new_state.end = True
+        elif new_state.count == board.size:
+            new_state.winner = 0
+            new_state.end = True
+        return new_state
+
+    def is_empty(self, i, j):
+        return self.cells[i * self.board.cols + j] == 0
+
+    def print_state(self):
+        cols = self.board.cols
+        for i in range(self.board.rows):
+            print("----" * cols + "-")
+            out = "| "
+            for j in range(cols):
+                token = {1: "*", -1: "x", 0: "0"}[self.cells[i * cols + j]]
+                out += token + " | "
+            print(out)
+        print("----" * cols + "-")
+
+
+# every reachable board indexed by a dense integer id,
+# with the game dynamics stored as NumPy tables so a move is an array lookup
+class StateTable:
+    # @boards: (n, BOARD_SIZE) int8 array of flat boards, id 0 is the empty board
+    # @next_ids: (n, BOARD_SIZE) int32 array, id reached by a move at each cell, -1 if illegal
+    # @ends: (n,) bool array, whether the board is terminal
+    # @winners: (n,) int8 array, 1 or -1 for a win, 0 otherwise
+    def __init__(self, boards, next_ids, ends, winners):
+        self.boards = boards
+        self.next_ids = next_ids
+        self.ends = ends
+        self.winners = winners
+        self.hashes = hash_boards(boards).astype(np.float64)
+
+    def __len__(self):
+        return len(self.boards)
+
+    @cached_property
+    def ids(self):
+        return dict(zip(self.hashes.tolist(), range(len(self.boards))))
+
+    @cached_property
+    def states(self):
+        return [self.make_state(state_id) for state_id in range(len(self.boards))]
+
+    # legal cells of each state, with the ids they lead to as an array
+    # and the hashes they lead to as a list
+    @cached_property
+    def moves(self):
+        moves = []
+        hashes = self.hashes.tolist()
+        for row in self.next_ids.tolist():
+            cells = [cell for cell, next_id in enumerate(row) if next_id >= 0]
+            next_ids = [row[cell] for cell in cells]
+            moves.append(
+                (
+                    cells,
+                    np.array(next_ids, dtype=np.intp),
+                    [hashes[next_id] for next_id in next_ids],
+                )
+            )
+        return moves
+
+    # ids of a batch of hash values
+    def ids_of_hashes(self, hashes):
+        return self.hash_order[
+            np.searchsorted(self.hashes, hashes, sorter=self.hash_order)
+        ]
+
+    @cached_property
+    def hash_order(self):
+        return np.argsort(self.hashes)
+
+    # for every state, the symmetry in SYMMETRIES mapping it to its canonical board,
+    # the one with the smallest hash among all its rotations and reflections
+    @cached_property
+    def symmetry_transforms(self):
+        hashes = [hash_boards(self.boards[:, cells]) for cells in SYMMETRIES]
+        return np.argmin(hashes, axis=0)
+
+    # id of the canonical board of every state
+    @cached_property
+    def symmetry_ids(self):
+        boards = np.take_along_axis(
+            self.boards, SYMMETRIES[self.symmetry_transforms], axis=1
+        )
+        return self.ids_of_hashes(hash_boards(boards))
+
+    # ids of the canonical boards
+    @cached_property
+    def canonical_ids(self):
+        return np.flatnonzero(self.symmetry_ids == np.arange(len(self.boards)))
+
+    # position of the canonical board of every state in canonical_ids
+    @cached_property
+    def symmetry_index(self):
+        return np.searchsorted(self.canonical_ids, self.symmetry_ids)
+
+    # number of chessmen on every board, the player to move is 1 when it is even
+    @cached_property
+    def depths(self):
+        return np.count_nonzero(self.boards, axis=1)
+
+    # game-theoretic value of every state for the player who moves first,
+    # 1 for a win, 0 for a tie and -1 for a lose, solved backwards from the full boards
+    def solve(self):
+        values = self.winners.astype(np.int8)
+        legal = self.next_ids >= 0
+        for depth in reversed(range(BOARD_SIZE)):
+            ids = np.flatnonzero((self.depths == depth) & ~self.ends)
+            next_values = values[self.next_ids[ids]]
+            if depth % 2 == 0:
+                values[ids] = np.where(legal[ids], next_values, -1).max(axis=1)
+            else:
+                values[ids] = np.where(legal[ids], next_values, 1).min(axis=1)
+        return values
+
+    # initial estimations indexed by state id: 1 for a win of @symbol,
+    # 0.5 for a tie or an unfinished game, 0 for a lose
+    def initial_values(self, symbol):
+        values = np.full(len(self.boards), 0.5)
+        values[self.ends & (self.winners == symbol)] = 1.0
+        values[self.ends & (self.winners == -symbol)] = 0.0
+        return values
+
+    # the {hash: value} form of an array of values indexed by state id
+    def values_to_dict(self, values):
+        return dict(zip(self.hashes.tolist(), np.asarray(values).tolist()))
+
+    # the array form of a {hash: value} dict, indexed by state id
+    def dict_to_values(self, estimations):
+        return np.array([estimations[hash_val] for hash_val in self.hashes.tolist()])
+
+    # breadth first enumeration of every board reachable from the empty one
+    @classmethod
+    def build(cls):
+        layer = np.zeros((1, BOARD_SIZE), dtype=np.int8)
+        layers = []
+        symbol = 1
+        while len(layer):
+            layers.append(layer)
+            _, ends = judge_boards(layer)
+            parents = layer[~ends]
+            children = []
+            for cell in range(BOARD_SIZE):
+                child = parents[parents[:, cell] == 0]
+                child[:, cell] = symbol
+                children.append(child)
+            children = np.concatenate(children)
+            _, first = np.unique(hash_boards(children), return_index=True)
+            layer = children[np.sort(first)]
+            symbol = -symbol
+        boards = np.concatenate(layers)
+        winners, ends = judge_boards(boards)
+
+        # the hash of a successor only differs by the weight of the new chessman
+        codes = hash_boards(boards)
+        order = np.argsort(codes)
+        symbols = np.where((boards != 0).sum(axis=1) % 2 == 0, 1, -1)
+        next_ids = np.full(boards.shape, -1, dtype=np.int32)
+        for cell in range(BOARD_SIZE):
+            legal = (boards[:, cell] == 0) & ~ends
+            next_codes = codes[legal] + symbols[legal] * HASH_WEIGHTS[cell]
+            next_ids[legal, cell] = order[
+                np.searchsorted(codes, next_codes, sorter=order)
+            ]
+        return cls(boards, next_ids, ends, winners)
+
+    # write the tables as .npy files into the directory @path,
+    # the directory is renamed into place so readers never see a partial table
+    def save(self, path):
+        tmp_path = "%s.tmp%d" % (path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        try:
+            for name in ("boards", "next_ids", "ends", "winners"):
+                np.save(os.path.join(tmp_path, name + ".npy"), getattr(self, name))
+            os.replace(tmp_path, path)
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    # memory map the tables saved by save(), processes loading the same
+    # directory share the pages instead of holding private copies
+    @classmethod
+    def load(cls, path):
+        arrays = [
+            np.asarray(np.load(os.path.join(path, name + ".npy"), mmap_mode="r"))
+            for name in ("boards", "next_ids", "ends", "winners")
+        ]
+        return cls(*arrays)
+
+    # a State sharing the precomputed hash, winner and end flag of a board
+    def make_state(self, state_id):
+        state = State()
+        state.data = (
+            self.boards[state_id].reshape(BOARD_ROWS, BOARD_COLS).astype(np.float64)
+        )
+        state.hash_val = self.hashes[state_id].item()
+        state.end = bool(self.ends[state_id])
+        state.winner = int(self.winners[state_id]) if state.end else None
+        state.state_id = state_id
+        return state
+
+    # id of any State, including ones built outside the table
+    def id_of(self, state):
+        state_id = state.state_id
+        if state_id is None:
+            return self.ids[state.hash()]
+        return state_id
+
+    # the legacy {hash: (state, is_end)} view of the table
+    def all_states(self):
+        return {state.hash_val: (state, state.end) for state in self.states}
+
+
+def get_state_cache_path():
+    return os.path.join(
+        STATE_CACHE_DIR,
+        "states_v%d_%dx%d" % (STATE_CACHE_VERSION, BOARD_ROWS, BOARD_COLS),
+    )
+
+
+_state_table = None
+
+
+# all possible board configurations, built on first use and cached on disk
+def get_state_table():
+    global _state_table
+    if _state_table is None:
+        path = get_state_cache_path()
+        try:
+            _state_table = StateTable.load(path)
+        except (OSError, ValueError):
+            _state_table = StateTable.build()
+            try:
+                _state_table.save(path)
+            except OSError:
+                # a read-only location only costs the rebuild next time
+                pass
+    return _state_table
+
+
+# `state_table` and `all_states` are resolved lazily so that importing
+# the module does not enumerate the state space
+def __getattr__(name):
+    if name == "state_table":
+        return get_state_table()
+    if name == "all_states":
+        globals()["all_states"] = get_state_table().all_states()
+        return globals()["all_states"]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+_minimax_values = None
+
+
+# StateTable.solve() of the state table, computed once and cached next to it on disk
+def get_minimax_values():
+    global _minimax_values
+    if _minimax_values is None:
+        path = os.path.join(get_state_cache_path(), "minimax.npy")
+        try:
+            _minimax_values = np.load(path)
+        except (OSError, ValueError):
+            _minimax_values = get_state_table().solve()
+            tmp_path = "%s.tmp%d.npy" % (path, os.getpid())
+            try:
+                np.save(tmp_path, _minimax_values)
+                os.replace(tmp_path, path)
+            except OSError:
+                pass
+    return _minimax_values
+
+
+# score the greedy policy of @player against the minimax solution in one sweep of the state table,
+# instead of playing games; returns a dict with
+#   optimal_move_rate: share of greedy moves that are optimal, over the states where the player moves
+#   reachable_optimal_move_rate: the same over the states reachable when the player follows its policy
+#   worst_case_outcome: outcome against an opponent exploiting the policy, with the worst tie-breaking,
+#                       1 for a win, 0 for a tie, -1 for a lose
+#   expected_outcome: the same, with ties broken at random as in act()
+def evaluate_policy(player):
+    state_table = get_state_table()
+    optimal = get_minimax_values()
+    next_ids = state_table.next_ids
+    legal = next_ids >= 0
+    greedy = player.greedy_moves()
+    optimal_moves = legal & (optimal[next_ids] == optimal[:, np.newaxis])
+    own = ~state_table.ends & (
+        np.where(state_table.depths % 2 == 0, 1, -1) == player.symbol
+    )
+    optimal_share = (greedy & optimal_moves).sum(axis=1) / np.maximum(
+        greedy.sum(axis=1), 1
+    )
+
+    # the moves each side may make: the greedy ones for the player, any for the opponent
+    moves = np.where(own[:, np.newaxis], greedy, legal)
+    reachable = np.zeros(len(state_table), dtype=bool)
+    reachable[0] = True
+    for depth in range(BOARD_SIZE):
+        ids = np.flatnonzero(reachable & (state_table.depths == depth))
+        reachable[next_ids[ids][moves[ids]]] = True
+
+    worst = (state_table.winners * player.symbol).astype(np.float64)
+    expected = worst.copy()
+    for depth in reversed(range(BOARD_SIZE)):
+        ids = np.flatnonzero((state_table.depths == depth) & ~state_table.ends)
+        mine = own[ids]
+        worst[ids] = np.where(moves[ids], worst[next_ids[ids]], np.inf).min(axis=1)
+        next_expected = np.where(moves[ids], expected[next_ids[ids]], np.nan)
+        expected[ids] = np.where(
+            mine, np.nanmean(next_expected, axis=1), np.nanmin(next_expected, axis=1)
+        )
+
+    return {
+        "optimal_move_rate": float(optimal_share[own].mean()),
+        "reachable_optimal_move_rate": float(optimal_share[own & reachable].mean()),
+        "worst_case_outcome": float(worst[0]),
+        "expected_outcome": float(expected[0]),
+    }
+
+
+# binary policy file: a header followed by the value of every state id,
+# which can be memory mapped and shared by every process reading it
+POLICY_MAGIC = b"TTTPOLCY"
+POLICY_VERSION = 1
+# magic, version, state table version, rows, cols, symbol, value size,
+# step_size, epsilon (NaN when unknown), number of values
+POLICY_HEADER = struct.Struct("<8sHHHHbB2xddQ")
+# values start on a 64 byte boundary
+POLICY_OFFSET = 64
+
+
+# write @values, indexed by state id, to a binary policy file at @path
+def write_policy_file(path, values, symbol, step_size, epsilon, dtype=np.float64):
+    values = np.asarray(values, dtype=dtype)
+    header = POLICY_HEADER.pack(
+        POLICY_MAGIC,
+        POLICY_VERSION,
+        STATE_CACHE_VERSION,
+        BOARD_ROWS,
+        BOARD_COLS,
+        symbol,
+        values.itemsize,
+        step_size,
+        epsilon,
+        len(values),
+    )
+    tmp_path = "%s.tmp%d" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(header.ljust(POLICY_OFFSET, b"\0"))
+        f.write(values.tobytes())
+    os.replace(tmp_path, path)
+
+
+# read the header of a binary policy file as a dict
+def read_policy_header(path):
+    with open(path, "rb") as f:
+        data = f.read(POLICY_HEADER.size)
+    if len(data) < POLICY_HEADER.size or data[:8] != POLICY_MAGIC:
+        raise ValueError("%s is not a policy file" % path)
+    fields = POLICY_HEADER.unpack(data)
+    header = dict(
+        zip(
+            (
+                "version",
+                "table_version",
+                "rows",
+                "cols",
+                "symbol",
+                "itemsize",
+                "step_size",
+                "epsilon",
+                "count",
+            ),
+            fields[1:],
+        )
+    )
+    if header["version"] != POLICY_VERSION:
+        raise ValueError("Unsupported policy file version %d" % header["version"])
+    if (header["rows"], header["cols"]) != (BOARD_ROWS, BOARD_COLS):
+        raise ValueError(
+            "Policy file is for a %dx%d board" % (header["rows"], header["cols"])
+        )
+    if header["table_version"] != STATE_CACHE_VERSION:
+        raise ValueError("Policy file uses another state table version")
+    return header
+
+
+# header and values of a binary policy file, the values are a copy-on-write
+# memory map, so processes reading the same file share its pages until they write
+def read_policy_file(path):
+    header = read_policy_header(path)
+    dtype = {4: np.float32, 8: np.float64}[header["itemsize"]]
+    values = np.memmap(
+        path, dtype=dtype, mode="c", offset=POLICY_OFFSET, shape=(header["count"],)
+    )
+    return header, np.asarray(values)
+
+
+# convert a pickled {hash: value} policy to a binary policy file,
+# the hyperparameters of old pickles are unknown and stored as NaN
+def convert_policy(source, target, symbol, dtype=np.float64):
+    with open(source, "rb") as f:
+        estimations = pickle.load(f)
+    values = get_state_table().dict_to_values(estimations)
+    write_policy_file(target, values, symbol, np.nan, np.nan, dtype)
+
+
+# convert policy_first.bin and policy_second.bin in the current directory
+def convert_policies():
+    for symbol in (1, -1):
+        name = "first" if symbol == 1 else "second"
+        convert_policy("policy_%s.bin" % name, "policy_%s.tttp" % name, symbol)
 
 
 class Judger:
     # @player1: the player who will move first, its chessman will be 1
     # @player2: another player with a chessman -1
-    def __init__(self, player1, player2):
+    # @board: a Board to play on instead of the enumerated 3 * 3 state table
+    def __init__(self, player1, player2, board=None):
         self.p1 = player1
         self.p2 = player2
+        self.board = board
         self.current_player = None
         self.p1_symbol = 1
         self.p2_symbol = -1
@@ -153,37 +828,146 @@ class Judger:
 
     # @print_state: if True, print each board during the game
     def play(self, print_state=False):
+        if self.board is not None:
+            return self.play_board(print_state)
         alternator = self.alternate()
         self.reset()
-        current_state = State()
+        state_table = get_state_table()
+        current_id = 0
+        current_state = state_table.states[current_id]
         self.p1.set_state(current_state)
         self.p2.set_state(current_state)
         if print_state:
             current_state.print_state()
+        profile = PROFILER.enabled
         while True:
             player = next(alternator)
             i, j, symbol = player.act()
-            next_state_hash = current_state.next_state(i, j, symbol).hash()
-            current_state, is_end = all_states[next_state_hash]
+            if profile:
+                start = perf_counter()
+            current_id = state_table.next_ids[current_id, i * BOARD_COLS + j]
+            if current_id < 0:
+                raise ValueError("Invalid move (%d, %d)" % (i, j))
+            current_state = state_table.states[current_id]
             self.p1.set_state(current_state)
             self.p2.set_state(current_state)
+            if profile:
+                PROFILER.add("Judger.play/step", perf_counter() - start)
             if print_state:
                 current_state.print_state()
-            if is_end:
+            if current_state.end:
+                if profile:
+                    PROFILER.count("Judger.play/games")
                 return current_state.winner
 
+    # the game loop on a Board, states are created as they are reached
+    def play_board(self, print_state=False):
+        alternator = self.alternate()
+        self.reset()
+        current_state = self.board.initial_state()
+        self.p1.set_state(current_state)
+        self.p2.set_state(current_state)
+        if print_state:
+            current_state.print_state()
+        while True:
+            player = next(alternator)
+            i, j, symbol = player.act()
+            current_state = current_state.next_state(i, j, symbol)
+            self.p1.set_state(current_state)
+            self.p2.set_state(current_state)
+            if print_state:
+                current_state.print_state()
+            if current_state.end:
+                return current_state.winner
+
+
+# plays many games in lockstep on the state table, for players in dense mode
+class BatchJudger:
+    # @player1: the player who will move first, its chessman will be 1
+    # @player2: another player with a chessman -1
+    # @batch_size: the number of games played by each call to play()
+    def __init__(self, player1, player2, batch_size=1024):
+        if not (player1.dense and player2.dense):
+            raise ValueError("BatchJudger needs players with dense=True")
+        self.p1 = player1
+        self.p2 = player2
+        self.batch_size = batch_size
+        self.p1.set_symbol(1)
+        self.p2.set_symbol(-1)
+        # state ids of each game, -1 after the game ended
+        self.states = None
+        # whether the move made from each state was greedy, per player
+        self.p1_greedy = None
+        self.p2_greedy = None
+
+    # play a batch of games, return the winner of each one
+    def play(self):
+        state_table = get_state_table()
+        games = np.arange(self.batch_size)
+        current = np.zeros(self.batch_size, dtype=np.intp)
+        states = np.full((self.batch_size, BOARD_SIZE + 1), -1, dtype=np.intp)
+        states[:, 0] = 0
+        greedy = np.ones((self.batch_size, BOARD_SIZE + 1), dtype=bool)
+        for step in range(BOARD_SIZE):
+            games = games[~state_table.ends[current[games]]]
+            if not len(games):
+                break
+            player = self.p1 if step % 2 == 0 else self.p2
+            next_ids = state_table.next_ids[current[games]]
+            legal = next_ids >= 0
+            values = np.where(
+                legal, player.estimations[player.value_ids(next_ids)], -np.inf
+            )
+            explore = player.rng.generator.random(len(games)) < player.epsilon
+            candidates = np.where(
+                explore[:, np.newaxis],
+                legal,
+                values == values.max(axis=1, keepdims=True),
+            )
+            # select one of the candidate cells at random
+            keys = player.rng.generator.random((len(games), BOARD_SIZE))
+            keys[~candidates] = -1
+            cells = keys.argmax(axis=1)
+            current[games] = next_ids[np.arange(len(games)), cells]
+            states[games, step + 1] = current[games]
+            greedy[games, step] = ~explore
+
+        # a player only explores on its own moves
+        steps = np.arange(BOARD_SIZE + 1)
+        self.states = states
+        self.p1_greedy = greedy | (steps % 2 == 1)
+        self.p2_greedy = greedy | (steps % 2 == 0)
+        return state_table.winners[current]
+
+    # update both players from the games of the last play()
+    def backup(self):
+        self.p1.backup_batch(self.states, self.p1_greedy)
+        self.p2.backup_batch(self.states, self.p2_greedy)
+
 
 # AI player
 class Player:
     # @step_size: the step size to update estimations
     # @epsilon: the probability to explore
-    def __init__(self, step_size=0.1, epsilon=0.1):
+    # @dense: keep estimations in a NumPy array indexed by state id instead of a dict keyed by hash
+    # @symmetry: share one estimation between boards that are rotations or reflections of each other
+    # @rng: the RandomPool to explore and break ties with, the shared one of rng.py by default
+    def __init__(
+        self, step_size=0.1, epsilon=0.1, dense=False, symmetry=False, rng=None
+    ):
         self.estimations = dict()
         self.step_size = step_size
         self.epsilon = epsilon
+        self.dense = dense
+        self.symmetry = symmetry
+        self.rng = RNG if rng is None else rng
         self.states = []
         self.greedy = []
         self.symbol = 0
+        # greedy policy frozen by compile_policy(), the best cells of state id i
+        # are best_cells[best_offsets[i]:best_offsets[i + 1]]
+        self.best_offsets = None
+        self.best_cells = None
 
     def reset(self):
         self.states = []
@@ -195,18 +979,37 @@ class Player:
 
     def set_symbol(self, symbol):
         self.symbol = symbol
-        for hash_val in all_states:
-            state, is_end = all_states[hash_val]
-            if is_end:
-                if state.winner == self.symbol:
-                    self.estimations[hash_val] = 1.0
-                elif state.winner == 0:
-                    # we need to distinguish between a tie and a lose
-                    self.estimations[hash_val] = 0.5
-                else:
-                    self.estimations[hash_val] = 0
-            else:
-                self.estimations[hash_val] = 0.5
+        # we need to distinguish between a tie and a lose
+        values = get_state_table().initial_values(symbol)
+        self.set_values(values[self.estimated_ids()])
+
+    # ids of the states that have their own estimation, in the order of the dense table
+    def estimated_ids(self):
+        state_table = get_state_table()
+        if self.symmetry:
+            return state_table.canonical_ids
+        return np.arange(len(state_table))
+
+    # position of an array of state ids in the dense table
+    def value_ids(self, state_ids):
+        if self.symmetry:
+            return get_state_table().symmetry_index[state_ids]
+        return state_ids
+
+    # the estimations as an array in the order of estimated_ids(), whatever the mode
+    def get_values(self):
+        if self.dense:
+            return self.estimations
+        hashes = get_state_table().hashes[self.estimated_ids()].tolist()
+        return np.array([self.estimations[hash_val] for hash_val in hashes])
+
+    def set_values(self, values):
+        self.best_offsets = self.best_cells = None
+        if self.dense:
+            self.estimations = values
+        else:
+            hashes = get_state_table().hashes[self.estimated_ids()].tolist()
+            self.estimations = dict(zip(hashes, np.asarray(values).tolist()))
 
     # update value estimation
     def backup(self):
@@ -215,7 +1018,37 @@ class Player:
         the value of the previous state is updated based on the value of the next state.
         :return:
         """
+        profile = PROFILER.enabled
+        if profile:
+            start = perf_counter()
+        self.best_offsets = self.best_cells = None
+        state_table = get_state_table()
+        if self.dense:
+            states = [state_table.id_of(state) for state in self.states]
+            if self.symmetry:
+                states = state_table.symmetry_index[states].tolist()
+            if profile:
+                update = perf_counter()
+                PROFILER.add("Player.backup/hash", update - start)
+            # scalar access through a memoryview avoids creating NumPy scalars
+            estimations = memoryview(self.estimations)
+            next_value = estimations[states[-1]]
+            for i in reversed(range(len(states) - 1)):
+                value = estimations[states[i]]
+                value += self.step_size * self.greedy[i] * (next_value - value)
+                estimations[states[i]] = value
+                next_value = value
+            if profile:
+                PROFILER.add("Player.backup/update", perf_counter() - update)
+            return
+
         states = [state.hash() for state in self.states]
+        if self.symmetry:
+            states = [state_table.id_of(state) for state in self.states]
+            states = state_table.hashes[state_table.symmetry_ids[states]].tolist()
+        if profile:
+            update = perf_counter()
+            PROFILER.add("Player.backup/hash", update - start)
 
         for i in reversed(range(len(states) - 1)):
             state = states[i]
@@ -223,44 +1056,256 @@ class Player:
                 self.estimations[states[i + 1]] - self.estimations[state]
             )
             self.estimations[state] += self.step_size * td_error
+        if profile:
+            PROFILER.add("Player.backup/update", perf_counter() - update)
+
+    # update value estimation from a batch of games at once, dense mode only
+    # @states: (games, steps) array of state ids, -1 after the end of a game
+    # @greedy: (games, steps) bool array, whether the move from each state was greedy
+    def backup_batch(self, states, greedy):
+        """
+        Update the value estimation of the states of all games at once, going backwards one move at a time.
+        A state is always reached after the same number of moves, so each step of the loop only needs the
+        values updated by the previous one. When n games update the same state, it moves towards the mean
+        of their targets by 1 - (1 - step_size) ^ n, as n sequential updates with the same target would.
+        :return:
+        """
+        self.best_offsets = self.best_cells = None
+        values = self.estimations
+        if self.symmetry:
+            states = np.where(states >= 0, self.value_ids(states), -1)
+        for i in reversed(range(states.shape[1] - 1)):
+            update = greedy[:, i] & (states[:, i + 1] >= 0)
+            if not update.any():
+                continue
+            state = states[update, i]
+            counts = np.bincount(state, minlength=len(values))
+            targets = np.bincount(
+                state, weights=values[states[update, i + 1]], minlength=len(values)
+            )
+            seen = np.flatnonzero(counts)
+            rate = 1 - (1 - self.step_size) ** counts[seen]
+            values[seen] += rate * (targets[seen] / counts[seen] - values[seen])
+
+    # (states, cells) bool array of the moves with the best estimation from every state
+    def greedy_moves(self):
+        state_table = get_state_table()
+        legal = state_table.next_ids >= 0
+        next_values = np.where(
+            legal, self.get_all_values()[state_table.next_ids], -np.inf
+        )
+        return legal & (next_values == next_values.max(axis=1, keepdims=True))
+
+    # freeze the greedy policy of the current estimations into the best cells of every state,
+    # with epsilon = 0 act() then draws one of them instead of scoring every move,
+    # until the estimations change again
+    def compile_policy(self):
+        best = self.greedy_moves()
+        self.best_offsets = np.concatenate(([0], np.cumsum(best.sum(axis=1)))).tolist()
+        self.best_cells = np.nonzero(best)[1].tolist()
 
     # choose an action based on the state
+    def act(self):
+        profile = PROFILER.enabled
+        if profile:
+            start = perf_counter()
+        state_table = get_state_table()
+        state_id = state_table.id_of(self.states[-1])
+        if self.best_cells is not None and self.epsilon == 0:
+            first = self.best_offsets[state_id]
+            ties = self.best_offsets[state_id + 1] - first
+            # select one of the actions of equal value at random
+            if ties > 1:
+                first += self.rng.integers(ties)
+            cell = self.best_cells[first]
+            if profile:
+                PROFILER.add("Player.act/compiled", perf_counter() - start)
+            return [cell // BOARD_COLS, cell % BOARD_COLS, self.symbol]
+        if self.symmetry:
+            # choose the move on the canonical board, then map it back
+            cell_map = SYMMETRIES[state_table.symmetry_transforms[state_id]]
+            state_id = state_table.symmetry_ids[state_id]
+        cells, next_ids, next_hashes = state_table.moves[state_id]
+        if profile:
+            select = perf_counter()
+            PROFILER.add("Player.act/lookup", select - start)
+
+        if self.rng.random() < self.epsilon:
+            cell = self.rng.choice(cells)
+            self.greedy[-1] = False
+        else:
+            if self.dense:
+                values = self.estimations[self.value_ids(next_ids)].tolist()
+            else:
+                if self.symmetry:
+                    next_ids = state_table.symmetry_ids[next_ids]
+                    next_hashes = state_table.hashes[next_ids].tolist()
+                values = [self.estimations[hash_val] for hash_val in next_hashes]
+            best_value = max(values)
+            best_cells = [
+                cell for cell, value in zip(cells, values) if value == best_value
+            ]
+            # select one of the actions of equal value at random
+            if len(best_cells) > 1:
+                cell = self.rng.choice(best_cells)
+            else:
+                cell = best_cells[0]
+
+        if self.symmetry:
+            cell = int(cell_map[cell])
+        if profile:
+            PROFILER.add("Player.act/select", perf_counter() - select)
+        return [cell // BOARD_COLS, cell % BOARD_COLS, self.symbol]
+
+    # @binary: the binary policy file instead of the pickled dict
+    def policy_path(self, binary=False):
+        return "policy_%s.%s" % (
+            "first" if self.symbol == 1 else "second",
+            "tttp" if binary else "bin",
+        )
+
+    # the estimations of every state id, whatever the mode
+    def get_all_values(self):
+        values = self.get_values()
+        if self.symmetry:
+            values = values[get_state_table().symmetry_index]
+        return values
+
+    # the pickled policy is always the {hash: value} dict of every state, whatever the mode
+    # @binary: write the binary policy file instead
+    # @dtype: type of the values in the binary policy file
+    def save_policy(self, binary=False, dtype=np.float64):
+        if binary:
+            write_policy_file(
+                self.policy_path(binary),
+                self.get_all_values(),
+                self.symbol,
+                self.step_size,
+                self.epsilon,
+                dtype,
+            )
+            return
+        estimations = self.estimations
+        if self.dense or self.symmetry:
+            estimations = get_state_table().values_to_dict(self.get_all_values())
+        with open(self.policy_path(), "wb") as f:
+            pickle.dump(estimations, f)
+
+    # @binary: read the binary policy file instead, in dense mode without symmetry
+    # the estimations then stay a copy-on-write memory map of the file
+    def load_policy(self, binary=False):
+        if binary:
+            header, values = read_policy_file(self.policy_path(binary))
+            if header["symbol"] != self.symbol:
+                raise ValueError("Policy file is for symbol %d" % header["symbol"])
+            if self.dense and not self.symmetry:
+                self.set_values(values)
+            else:
+                self.set_values(np.array(values[self.estimated_ids()], np.float64))
+            return
+        with open(self.policy_path(), "rb") as f:
+            estimations = pickle.load(f)
+        if self.dense or self.symmetry:
+            values = get_state_table().dict_to_values(estimations)
+            self.set_values(values[self.estimated_ids()])
+        else:
+            self.best_offsets = self.best_cells = None
+            self.estimations = estimations
+
+
+# AI player for a Board, its estimations only hold the states it has visited
+class BoardPlayer:
+    # @board: the Board the games are played on
+    # @step_size: the step size to update estimations
+    # @epsilon: the probability to explore
+    # @rng: the RandomPool to explore and break ties with, the shared one of rng.py by default
+    def __init__(self, board, step_size=0.1, epsilon=0.1, rng=None):
+        self.board = board
+        self.estimations = dict()
+        self.step_size = step_size
+        self.epsilon = epsilon
+        self.rng = RNG if rng is None else rng
+        self.states = []
+        self.greedy = []
+        self.symbol = 0
+
+    def reset(self):
+        self.states = []
+        self.greedy = []
+
+    def set_state(self, state):
+        self.states.append(state)
+        self.greedy.append(True)
+
+    def set_symbol(self, symbol):
+        self.symbol = symbol
+
+    # value of a state never updated yet, same as set_symbol() of Player
+    def initial_value(self, winner):
+        if winner == self.symbol:
+            return 1.0
+        if winner is None or winner == 0:
+            return 0.5
+        return 0.0
+
+    def get_value(self, state):
+        value = self.estimations.get(state.hash_val)
+        if value is None:
+            value = self.initial_value(state.winner)
+        return value
+
+    # update value estimation
+    def backup(self):
+        states = self.states
+        next_value = self.get_value(states[-1])
+        for i in reversed(range(len(states) - 1)):
+            value = self.get_value(states[i])
+            value += self.step_size * self.greedy[i] * (next_value - value)
+            self.estimations[states[i].hash_val] = value
+            next_value = value
+
+    # choose an action based on the state, successors are only hashed, not created
     def act(self):
         state = self.states[-1]
-        next_states = []
-        next_positions = []
-        for i in range(BOARD_ROWS):
-            for j in range(BOARD_COLS):
-                if state.data[i, j] == 0:
-                    next_positions.append([i, j])
-                    next_states.append(state.next_state(i, j, self.symbol).hash())
+        board = self.board
+        cells = [cell for cell, symbol in enumerate(state.cells) if symbol == 0]
 
-        if np.random.rand() < self.epsilon:
-            action = next_positions[np.random.randint(len(next_positions))]
-            action.append(self.symbol)
+        if self.rng.random() < self.epsilon:
+            cell = self.rng.choice(cells)
             self.greedy[-1] = False
-            return action
+            return [cell // board.cols, cell % board.cols, self.symbol]
 
         values = []
-        for hash_val, pos in zip(next_states, next_positions):
-            values.append((self.estimations[hash_val], pos))
-        # to select one of the actions of equal value at random due to Python's sort is stable
-        np.random.shuffle(values)
-        values.sort(key=lambda x: x[0], reverse=True)
-        action = values[0][1]
-        action.append(self.symbol)
-        return action
+        for cell in cells:
+            value = self.estimations.get(
+                state.hash_val ^ board.zobrist[cell][self.symbol]
+            )
+            if value is None:
+                if board.is_win(state.cells, cell, self.symbol):
+                    value = 1.0
+                else:
+                    value = 0.5
+            values.append(value)
+        best_value = max(values)
+        best_cells = [cell for cell, value in zip(cells, values) if value == best_value]
+        # select one of the actions of equal value at random
+        cell = self.rng.choice(best_cells)
+        return [cell // board.cols, cell % board.cols, self.symbol]
+
+    def policy_path(self):
+        return "policy_%s_%dx%d_%d.bin" % (
+            "first" if self.symbol == 1 else "second",
+            self.board.rows,
+            self.board.cols,
+            self.board.win_length,
+        )
 
     def save_policy(self):
-        with open(
-            "policy_%s.bin" % ("first" if self.symbol == 1 else "second"), "wb"
-        ) as f:
+        with open(self.policy_path(), "wb") as f:
             pickle.dump(self.estimations, f)
 
     def load_policy(self):
-        with open(
-            "policy_%s.bin" % ("first" if self.symbol == 1 else "second"), "rb"
-        ) as f:
+        with open(self.policy_path(), "rb") as f:
             self.estimations = pickle.load(f)
 
 
@@ -293,12 +1338,295 @@ class HumanPlayer:
         return i, j, self.symbol
 
 
-def train(epochs, print_every_n=500):
-    player1 = Player(epsilon=0.01)
-    player2 = Player(epsilon=0.01)
+# controller of train() that explores more and learns faster in the first games, then stops
+# once the values change by less than 2e-4 on average and the draw rate by less than 0.01
+# over three windows of 2000 games in a row
+def make_controller():
+    return TrainingController(
+        epsilon=Schedule(0.1, 0.01, 20000),
+        step_size=Schedule(0.5, 0.05, 20000, "exponential"),
+        window=2000,
+        value_tolerance=2e-4,
+        score_tolerance=0.01,
+        patience=3,
+    )
+
+
+# copy of everything train() needs to resume, taken in the training thread for a Checkpointer
+def training_snapshot(player1, player2, player1_win, player2_win, controller):
+    return {
+        "values": (np.array(player1.get_values()), np.array(player2.get_values())),
+        "wins": (player1_win, player2_win),
+        "rng": player1.rng.get_state(),
+        "controller": None if controller is None else controller.get_state(),
+    }
+
+
+# restore a snapshot of training_snapshot(), returns the epoch it was taken after and the wins
+def restore_training(snapshot, player1, player2, controller):
+    player1.set_values(snapshot["values"][0])
+    player2.set_values(snapshot["values"][1])
+    player1.rng.set_state(snapshot["rng"])
+    if controller is not None and snapshot["controller"] is not None:
+        controller.set_state(snapshot["controller"])
+    return snapshot["epoch"], snapshot["wins"]
+
+
+# @profile: collect phase timings, printed with the progress and at the end
+# @profile_path: also save the phase timings there as JSON
+# @controller: a training.TrainingController, to schedule epsilon and step_size and stop
+#              once the values and the draw rate converge, @epochs is then the most games
+# @checkpoint_every: checkpoint the players, the win counts and the random stream to
+#                    @checkpoint_path every this many games, from a background thread
+# @resume: continue from the checkpoint at @checkpoint_path, if there is one
+# @dense, @symmetry: the modes of both players, see Player
+def train(
+    epochs,
+    print_every_n=500,
+    profile=False,
+    profile_path=None,
+    controller=None,
+    checkpoint_every=0,
+    checkpoint_path="checkpoint_tic_tac_toe.bin",
+    resume=False,
+    dense=False,
+    symmetry=False,
+):
+    if profile:
+        PROFILER.reset()
+        PROFILER.enable()
+    player1 = Player(epsilon=0.01, dense=dense, symmetry=symmetry)
+    player2 = Player(epsilon=0.01, dense=dense, symmetry=symmetry)
     judger = Judger(player1, player2)
     player1_win = 0.0
     player2_win = 0.0
+    if controller is not None:
+        controller.reset()
+    start = 1
+    snapshot = load_checkpoint(checkpoint_path) if resume else None
+    if snapshot is not None:
+        done, (player1_win, player2_win) = restore_training(
+            snapshot, player1, player2, controller
+        )
+        start = done + 1
+        print("Resuming after game %d" % done)
+    checkpointer = None
+    if checkpoint_every:
+        checkpointer = Checkpointer(checkpoint_path, checkpoint_every)
+    try:
+        for i in range(start, epochs + 1):
+            if controller is not None:
+                controller.apply(i, player1, player2)
+            winner = judger.play(print_state=False)
+            if winner == 1:
+                player1_win += 1
+            if winner == -1:
+                player2_win += 1
+            if i % print_every_n == 0:
+                print(
+                    "Epoch %d, player 1 winrate: %.02f, player 2 winrate: %.02f"
+                    % (i, player1_win / i, player2_win / i)
+                )
+                if profile:
+                    PROFILER.report(profile_path)
+            player1.backup()
+            player2.backup()
+            judger.reset()
+            if controller is not None and controller.update(
+                i,
+                winner == 0,
+                lambda: np.concatenate((player1.get_values(), player2.get_values())),
+            ):
+                print("Converged after %d games, %s" % (i, controller.summary()))
+                break
+            if checkpointer is not None and checkpointer.due(i):
+                checkpointer.save(
+                    i,
+                    training_snapshot(
+                        player1, player2, player1_win, player2_win, controller
+                    ),
+                )
+    finally:
+        # also writes the last checkpoint when training is interrupted
+        if checkpointer is not None:
+            checkpointer.close()
+    player1.save_policy()
+    player2.save_policy()
+    if profile:
+        PROFILER.report(profile_path)
+        PROFILER.disable()
+
+
+# same as train(), but the games are played @batch_size at a time by a BatchJudger
+# @symmetry: share the estimations of symmetric boards, see Player
+def train_batched(epochs, print_every_n=500, batch_size=1024, symmetry=False):
+    player1 = Player(epsilon=0.01, dense=True, symmetry=symmetry)
+    player2 = Player(epsilon=0.01, dense=True, symmetry=symmetry)
+    judger = BatchJudger(player1, player2, batch_size)
+    player1_win = 0.0
+    player2_win = 0.0
+    games = 0
+    while games < epochs:
+        judger.batch_size = min(batch_size, epochs - games)
+        winners = judger.play()
+        player1_win += np.count_nonzero(winners == 1)
+        player2_win += np.count_nonzero(winners == -1)
+        if (games + len(winners)) // print_every_n > games // print_every_n:
+            i = games + len(winners)
+            print(
+                "Epoch %d, player 1 winrate: %.02f, player 2 winrate: %.02f"
+                % (i, player1_win / i, player2_win / i)
+            )
+        games += len(winners)
+        judger.backup()
+    player1.save_policy()
+    player2.save_policy()
+
+
+# one process of train_parallel(), plays @games games with Judger on the shared tables
+# @worker: index of this worker, its slot in the tables when averaging
+# @rounds: the number of averaged merges, the same for every worker
+# @seed: the seed of train_parallel(), each worker draws from its own stream of it
+def train_worker(
+    shm_name, shape, mode, worker, games, sync_every, rounds, barrier, results, seed
+):
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    tables = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    rng = worker_pool(seed, worker)
+    player1 = Player(epsilon=0.01, dense=True, rng=rng)
+    player2 = Player(epsilon=0.01, dense=True, rng=rng)
+    judger = Judger(player1, player2)
+    if mode == "async":
+        # lock-free: both players update the shared arrays in place
+        player1.estimations = tables[0, 0]
+        player2.estimations = tables[0, 1]
+    else:
+        player1.estimations = tables[worker, 0].copy()
+        player2.estimations = tables[worker, 1].copy()
+    player1_win = 0
+    player2_win = 0
+    for _ in range(rounds):
+        for _ in range(min(games, sync_every)):
+            winner = judger.play()
+            if winner == 1:
+                player1_win += 1
+            if winner == -1:
+                player2_win += 1
+            player1.backup()
+            player2.backup()
+            judger.reset()
+        games -= min(games, sync_every)
+        if mode == "average":
+            tables[worker, 0] = player1.estimations
+            tables[worker, 1] = player2.estimations
+            barrier.wait()
+            mean = tables.mean(axis=0)
+            # nobody overwrites its slot before everyone has read the mean
+            barrier.wait()
+            player1.estimations[:] = mean[0]
+            player2.estimations[:] = mean[1]
+    results.put((player1_win, player2_win))
+    # the views must be released before the shared memory can be closed
+    del tables, judger, player1, player2
+    shm.close()
+
+
+# same as train(), but the games are spread over @workers processes sharing
+# the value tables through multiprocessing.shared_memory
+# @mode: "async" for lock-free updates of one shared table,
+#        "average" for private tables averaged every @sync_every games
+# @seed: seed of the independent random streams of the workers, fresh entropy if None
+def train_parallel(epochs, workers=4, mode="async", sync_every=1000, seed=None):
+    # imported here, multiprocessing alone would double the import time of the module
+    import multiprocessing as mp
+    import queue
+    from multiprocessing import shared_memory
+
+    if mode not in ("async", "average"):
+        raise ValueError("Invalid mode %r" % mode)
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    player1 = Player(epsilon=0.01, dense=True)
+    player2 = Player(epsilon=0.01, dense=True)
+    player1.set_symbol(1)
+    player2.set_symbol(-1)
+    shape = (1 if mode == "async" else workers, 2, len(player1.estimations))
+    shm = shared_memory.SharedMemory(
+        create=True, size=int(np.prod(shape)) * np.dtype(np.float64).itemsize
+    )
+    try:
+        tables = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        tables[:, 0] = player1.estimations
+        tables[:, 1] = player2.estimations
+        barrier = mp.Barrier(workers)
+        results = mp.Queue()
+        games = [epochs // workers + (i < epochs % workers) for i in range(workers)]
+        rounds = max(1, -(-max(games) // sync_every))
+        processes = [
+            mp.Process(
+                target=train_worker,
+                args=(
+                    shm.name,
+                    shape,
+                    mode,
+                    i,
+                    games[i],
+                    sync_every,
+                    rounds,
+                    barrier,
+                    results,
+                    seed,
+                ),
+            )
+            for i in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        wins = []
+        while len(wins) < workers:
+            try:
+                wins.append(results.get(timeout=0.1))
+            except queue.Empty:
+                # a worker that died would never report, and the others would wait
+                # for it at the barrier forever
+                failed = [
+                    (i, process.exitcode)
+                    for i, process in enumerate(processes)
+                    if process.exitcode not in (None, 0)
+                ]
+                if failed:
+                    barrier.abort()
+                    for process in processes:
+                        process.terminate()
+                        process.join()
+                    raise RuntimeError("Worker %d exited with code %d" % failed[0])
+        for process in processes:
+            process.join()
+        player1.estimations = tables[:, 0].mean(axis=0)
+        player2.estimations = tables[:, 1].mean(axis=0)
+        del tables
+    finally:
+        shm.unlink()
+    shm.close()
+    player1_win, player2_win = np.sum(wins, axis=0)
+    print(
+        "Epoch %d, player 1 winrate: %.02f, player 2 winrate: %.02f"
+        % (epochs, player1_win / epochs, player2_win / epochs)
+    )
+    player1.save_policy()
+    player2.save_policy()
+
+
+# same as train(), on a @rows * @cols board where @win_length in a row win
+def train_board(rows, cols, win_length, epochs, print_every_n=500):
+    board = Board(rows, cols, win_length)
+    player1 = BoardPlayer(board, epsilon=0.01)
+    player2 = BoardPlayer(board, epsilon=0.01)
+    judger = Judger(player1, player2, board)
+    player1_win = 0.0
+    player2_win = 0.0
     for i in range(1, epochs + 1):
         winner = judger.play(print_state=False)
         if winner == 1:
@@ -307,8 +1635,8 @@ def train(epochs, print_every_n=500):
             player2_win += 1
         if i % print_every_n == 0:
             print(
-                "Epoch %d, player 1 winrate: %.02f, player 2 winrate: %.02f"
-                % (i, player1_win / i, player2_win / i)
+                "Epoch %d, player 1 winrate: %.02f, player 2 winrate: %.02f, states: %d"
+                % (i, player1_win / i, player2_win / i, len(player1.estimations))
             )
         player1.backup()
         player2.backup()
@@ -323,6 +1651,8 @@ def compete(turns):
     judger = Judger(player1, player2)
     player1.load_policy()
     player2.load_policy()
+    player1.compile_policy()
+    player2.compile_policy()
     player1_win = 0.0
     player2_win = 0.0
     for _ in range(turns):
@@ -336,6 +1666,29 @@ def compete(turns):
         "%d turns, player 1 win %.02f, player 2 win %.02f"
         % (turns, player1_win / turns, player2_win / turns)
     )
+    return player1_win / turns, player2_win / turns
+
+
+# score both saved policies against the minimax solution without playing any game
+def evaluate():
+    results = []
+    for symbol in (1, -1):
+        player = Player(epsilon=0)
+        player.set_symbol(symbol)
+        player.load_policy()
+        result = evaluate_policy(player)
+        print(
+            "player %d: optimal moves %.04f (reachable %.04f), worst case %d, expected %.02f"
+            % (
+                1 if symbol == 1 else 2,
+                result["optimal_move_rate"],
+                result["reachable_optimal_move_rate"],
+                result["worst_case_outcome"],
+                result["expected_outcome"],
+            )
+        )
+        results.append(result)
+    return results
 
 
 # The game is a zero sum game. If both players are playing with an optimal strategy, every game will end in a tie.
@@ -346,6 +1699,7 @@ def play():
         player2 = Player(epsilon=0)
         judger = Judger(player1, player2)
         player2.load_policy()
+        player2.compile_policy()
         winner = judger.play()
         if winner == player2.symbol:
             print("You lose!")
@@ -356,6 +1710,6 @@ def play():
 
 
 if __name__ == "__main__":
-    train(int(1e5))
+    train(int(1e5), controller=make_controller())
     compete(int(1e3))
     play()
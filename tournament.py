@@ -0,0 +1,178 @@
+# Round-robin tournament between saved tic-tac-toe policies.
+#
+#   python tournament.py checkpoints/ --games 1000 --workers 4
+#
+# A checkpoint is a pair of policy files with the same prefix, e.g.
+# run1_first.tttp and run1_second.tttp, or the pickled run1_first.bin and
+# run1_second.bin; the policy_first / policy_second files written by train()
+# are the checkpoint "policy". Every pair of checkpoints plays @games games in
+# both seat orders with a BatchJudger, the matches spread over a process pool
+# whose workers load every policy once. The result is a win/draw/loss matrix
+# and Elo ratings fitted to it.
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import pickle
+import sys
+
+import numpy as np
+
+import tic_tac_toe
+from rng import worker_pool
+
+SEATS = {"first": 1, "second": -1}
+
+# the policies of every checkpoint, {name: {symbol: values}}, loaded once per worker
+POLICIES = None
+
+
+def policy_files(directory):
+    """{name: {symbol: path}} of the policy files in @directory."""
+    checkpoints = {}
+    for file_name in sorted(os.listdir(directory)):
+        stem, extension = os.path.splitext(file_name)
+        if extension not in (".tttp", ".bin"):
+            continue
+        name, _, seat = stem.rpartition("_")
+        if not name or seat not in SEATS:
+            continue
+        checkpoints.setdefault(name, {})[SEATS[seat]] = os.path.join(
+            directory, file_name
+        )
+    return checkpoints
+
+
+def load_policy(path, symbol):
+    """Values of every state id in the policy file at @path, binary or pickled."""
+    if path.endswith(".tttp"):
+        header, values = tic_tac_toe.read_policy_file(path)
+        if header["symbol"] != symbol:
+            raise ValueError("%s is for symbol %d" % (path, header["symbol"]))
+        return values
+    with open(path, "rb") as f:
+        estimations = pickle.load(f)
+    return tic_tac_toe.get_state_table().dict_to_values(estimations)
+
+
+def init_worker(directory):
+    """Load every policy of @directory into POLICIES, once per worker."""
+    global POLICIES
+    tic_tac_toe.get_state_table()
+    POLICIES = {
+        name: {symbol: load_policy(path, symbol) for symbol, path in seats.items()}
+        for name, seats in policy_files(directory).items()
+    }
+
+
+def play_match(task):
+    """Play @games games of the first checkpoint against the second one, both greedy."""
+    first, second, games, batch_size, seed, index = task
+    rng = worker_pool(seed, index)
+    player1 = tic_tac_toe.Player(epsilon=0, dense=True, rng=rng)
+    player2 = tic_tac_toe.Player(epsilon=0, dense=True, rng=rng)
+    judger = tic_tac_toe.BatchJudger(player1, player2, batch_size)
+    player1.set_values(POLICIES[first][1])
+    player2.set_values(POLICIES[second][-1])
+    counts = np.zeros(3, dtype=np.int64)
+    played = 0
+    while played < games:
+        judger.batch_size = min(batch_size, games - played)
+        # winners are 1, 0 and -1, counted as first wins, draws and second wins
+        counts += np.bincount(1 - judger.play(), minlength=3)
+        played += judger.batch_size
+    return first, second, counts.tolist()
+
+
+def elo_ratings(scores, games, base=1500.0, iterations=1000):
+    """Elo ratings fitting @scores[i, j], the points of i in its @games[i, j] games against j."""
+    # one virtual draw in every pairing keeps the ratings finite when a checkpoint wins everything
+    played = games > 0
+    scores = scores + 0.5 * played
+    games = games + played
+    strengths = np.ones(len(scores))
+    for _ in range(iterations):
+        # minorization-maximization update of the Bradley-Terry model
+        pair_strengths = strengths[:, np.newaxis] + strengths[np.newaxis, :]
+        strengths = scores.sum(axis=1) / (games / pair_strengths).sum(axis=1)
+        strengths /= np.exp(np.log(strengths).mean())
+    return base + 400 * np.log10(strengths)
+
+
+def tournament(directory, games=1000, workers=None, batch_size=1024, seed=0):
+    """Play every pair of checkpoints in @directory, return the names, W/D/L matrix and ratings."""
+    seats = policy_files(directory)
+    names = sorted(seats)
+    index = {name: i for i, name in enumerate(names)}
+    tasks = [
+        (first, second, games, batch_size, seed)
+        for first in names
+        for second in names
+        if first != second and 1 in seats[first] and -1 in seats[second]
+    ]
+    tasks = [task + (i,) for i, task in enumerate(tasks)]
+    # build and save the state table cache before the workers start, so none of them rebuilds it
+    tic_tac_toe.get_state_table()
+    # wins, draws and losses of the row checkpoint against the column one, both seat orders
+    results = np.zeros((len(names), len(names), 3), dtype=np.int64)
+    with mp.Pool(workers, initializer=init_worker, initargs=(directory,)) as pool:
+        for first, second, counts in pool.imap_unordered(play_match, tasks):
+            results[index[first], index[second]] += counts
+            results[index[second], index[first]] += counts[::-1]
+    scores = results[:, :, 0] + 0.5 * results[:, :, 1]
+    ratings = elo_ratings(scores, results.sum(axis=2))
+    return names, results, ratings
+
+
+def print_results(names, results, ratings):
+    """The W/D/L matrix and the ratings as text tables."""
+    cells = [
+        [
+            "-" if i == j else "%d/%d/%d" % tuple(results[i, j])
+            for j in range(len(names))
+        ]
+        for i in range(len(names))
+    ]
+    width = max(len(text) for text in names + sum(cells, []))
+    print(" " * width + "".join(f" | {name:>{width}}" for name in names))
+    for name, row in zip(names, cells):
+        print(f"{name:{width}}" + "".join(f" | {cell:>{width}}" for cell in row))
+    print()
+    for i in np.argsort(-ratings):
+        wins, draws, losses = results[i].sum(axis=0)
+        print(f"{names[i]:{width}} {ratings[i]:7.1f}  W {wins} D {draws} L {losses}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Round-robin tournament between tic-tac-toe policy checkpoints."
+    )
+    parser.add_argument("directory")
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results there as JSON")
+    args = parser.parse_args()
+
+    names, results, ratings = tournament(
+        args.directory, args.games, args.workers, args.batch_size, args.seed
+    )
+    print_results(names, results, ratings)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "names": names,
+                    "wins_draws_losses": results.tolist(),
+                    "ratings": dict(zip(names, ratings.tolist())),
+                },
+                f,
+                indent=2,
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+# Early stopping and hyperparameter schedules for the train() loops of
+# tic_tac_toe.py and can_collector.py. A TrainingController sets the scheduled
+# epsilon and step_size of the agents before every epoch, and stops training
+# once the value tables and the windowed score have stopped changing.
+
+import numpy as np
+
+
+class Schedule:
+    """Value of a hyperparameter at every epoch, decaying from start to end."""
+
+    def __init__(self, start, end=None, epochs=1, decay="linear"):
+        """Decay from @start to @end over @epochs epochs, "linear" or "exponential", constant without @end."""
+        if decay not in ("linear", "exponential"):
+            raise ValueError("Invalid decay %r" % decay)
+        if decay == "exponential" and end is not None and min(start, end) <= 0:
+            raise ValueError("An exponential decay needs positive values")
+        self.start = start
+        self.end = end
+        self.epochs = epochs
+        self.decay = decay
+
+    def __call__(self, epoch):
+        """Value at @epoch, counted from 1, and end after the last decaying epoch."""
+        if self.end is None:
+            return self.start
+        fraction = min((epoch - 1) / max(self.epochs - 1, 1), 1.0)
+        if self.decay == "linear":
+            return self.start + (self.end - self.start) * fraction
+        return self.start * (self.end / self.start) ** fraction
+
+
+class TrainingController:
+    """Schedules of epsilon and step_size, and convergence checks every window of epochs.
+
+    A check compares the mean score of the window with the one of the
+    previous window, and the values with the ones of the previous check,
+    by their mean absolute change. Training is converged after @patience
+    checks in a row where both changed less than their tolerance; a
+    tolerance of None leaves that criterion out, and with both None the
+    controller only runs the schedules. Between checks an epoch costs one
+    addition, the values are only read at checks.
+    """
+
+    def __init__(
+        self,
+        epsilon=None,
+        step_size=None,
+        window=1000,
+        value_tolerance=None,
+        score_tolerance=None,
+        patience=2,
+        min_epochs=0,
+    ):
+        """Controller of the Schedules (or constants) @epsilon and @step_size, None to leave them be."""
+        self.epsilon = self.as_schedule(epsilon)
+        self.step_size = self.as_schedule(step_size)
+        self.window = window
+        self.value_tolerance = value_tolerance
+        self.score_tolerance = score_tolerance
+        self.patience = patience
+        self.min_epochs = min_epochs
+        self.reset()
+
+    @staticmethod
+    def as_schedule(value):
+        """@value as a Schedule, None stays None."""
+        if value is None or isinstance(value, Schedule):
+            return value
+        return Schedule(value)
+
+    def reset(self):
+        """Forget the statistics of the previous training."""
+        self.score_sum = 0.0
+        self.scores = []
+        self.value_changes = []
+        self.last_values = None
+        self.stable_checks = 0
+        self.stopped_at = None
+
+    def get_state(self):
+        """The statistics gathered so far, to resume with set_state()."""
+        return {
+            "score_sum": self.score_sum,
+            "scores": list(self.scores),
+            "value_changes": list(self.value_changes),
+            "last_values": self.last_values,
+            "stable_checks": self.stable_checks,
+        }
+
+    def set_state(self, state):
+        """Resume from the statistics saved by get_state()."""
+        self.score_sum = state["score_sum"]
+        self.scores = list(state["scores"])
+        self.value_changes = list(state["value_changes"])
+        self.last_values = state["last_values"]
+        self.stable_checks = state["stable_checks"]
+        self.stopped_at = None
+
+    def apply(self, epoch, *agents):
+        """Set the scheduled epsilon and step_size of @agents for @epoch."""
+        if self.epsilon is not None:
+            epsilon = self.epsilon(epoch)
+            for agent in agents:
+                agent.epsilon = epsilon
+        if self.step_size is not None:
+            step_size = self.step_size(epoch)
+            for agent in agents:
+                agent.step_size = step_size
+
+    def update(self, epoch, score, get_values=None):
+        """Record the @score of @epoch, return whether training has converged.
+
+        get_values is called at the checks only, and returns the value
+        tables to compare as one array.
+        """
+        self.score_sum += score
+        if epoch % self.window:
+            return False
+        self.scores.append(self.score_sum / self.window)
+        self.score_sum = 0.0
+        stable = True
+        if self.score_tolerance is not None:
+            stable = (
+                len(self.scores) > 1
+                and abs(self.scores[-1] - self.scores[-2]) < self.score_tolerance
+            )
+        if self.value_tolerance is not None:
+            values = np.array(get_values(), dtype=np.float64)
+            if self.last_values is None:
+                stable = False
+            else:
+                change = float(np.abs(values - self.last_values).mean())
+                self.value_changes.append(change)
+                stable = stable and change < self.value_tolerance
+            self.last_values = values
+        if self.value_tolerance is None and self.score_tolerance is None:
+            stable = False
+        self.stable_checks = self.stable_checks + 1 if stable else 0
+        if self.stable_checks >= self.patience and epoch >= self.min_epochs:
+            self.stopped_at = epoch
+            return True
+        return False
+
+    def summary(self):
+        """The statistics of the last check as text."""
+        text = "window score %.4f" % self.scores[-1] if self.scores else "no check yet"
+        if self.value_changes:
+            text += ", mean value change %.2e" % self.value_changes[-1]
+        return text